@@ -0,0 +1,74 @@
+import time
+import torch
+import torch.nn.functional as F
+from models.model_single import ModelEmb
+from segment_anything import sam_model_registry
+from train import get_input_dict, norm_batch, precision_context
+from devices import setup_device
+from inference import sam_call
+
+
+def time_forward(forward, iterations, warmup):
+    # Mean seconds of one call, after a few warm-up calls that let oneDNN pick its kernels
+    for _ in range(warmup):
+        forward()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        forward()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark(model, sam, batch_size, Idim, iterations, warmup):
+    # Throughput of ModelEmb alone, and of the whole prediction (ModelEmb, SAM encoder and decoder) when SAM is given
+    device = torch.device('cpu')
+    imgs = torch.randn((batch_size, 3, 1024, 1024), device=device)
+    imgs_small = F.interpolate(imgs, (Idim, Idim), mode='bilinear', align_corners=True)
+    results = {'model_emb': batch_size / time_forward(lambda: model(imgs_small), iterations, warmup)}
+    if sam is not None:
+        sizes = torch.Tensor([[1024, 1024]] * batch_size)
+        batched_input = get_input_dict(imgs, sizes, sizes)
+        results['full'] = batch_size / time_forward(
+            lambda: norm_batch(sam_call(batched_input, sam, model(imgs_small))), iterations, warmup)
+    return results
+
+
+def main(args):
+    device = torch.device('cpu')
+    sam = None
+    if args['sam_checkpoint']:
+        sam = sam_model_registry[args['model_type']](checkpoint=args['sam_checkpoint'])
+        sam.to(device=device).eval()
+
+    print('threads,memory_format,precision,batch_size,model_emb_images_per_s,full_images_per_s')
+    for num_threads in args['num_threads']:
+        for memory_format in args['memory_formats']:
+            model = setup_device(ModelEmb(args=args), device, num_threads, memory_format).eval()
+            for precision in args['precisions']:
+                for batch_size in args['batch_sizes']:
+                    with torch.inference_mode(), precision_context(device, precision):
+                        results = benchmark(model, sam, batch_size, int(args['Idim']), args['iterations'], args['warmup'])
+                    full = '{:.2f}'.format(results['full']) if 'full' in results else ''
+                    print('{},{},{},{},{:.2f},{}'.format(torch.get_num_threads(), memory_format, precision, batch_size,
+                                                         results['model_emb'], full))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='CPU throughput of AutoSAM inference')
+    parser.add_argument('-depth_wise', '--depth_wise', default=False, help='image size', required=False)
+    parser.add_argument('-order', '--order', default=85, help='image size', required=False)
+    parser.add_argument('-Idim', '--Idim', default=256, help='image size', required=False)
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[torch.get_num_threads()],
+                        help='Numbers of CPU threads to compare')
+    parser.add_argument('--memory_formats', type=str, nargs='+', default=['contiguous', 'channels_last'],
+                        choices=['contiguous', 'channels_last'], help='Memory formats of the model weights to compare')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32'], choices=['fp32', 'bf16'],
+                        help='Autocast precisions to compare')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='Batch sizes to compare')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed calls per setting')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed calls before timing')
+    parser.add_argument('--sam_checkpoint', type=str, default=None,
+                        help='Path to SAM checkpoint; without it only ModelEmb is timed')
+    parser.add_argument('--model_type', type=str, default="vit_h", help='Model type for SAM (e.g., vit_h)')
+    args = vars(parser.parse_args())
+    main(args)
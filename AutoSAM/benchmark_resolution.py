@@ -0,0 +1,83 @@
+import time
+import torch
+from models.model_single import ModelEmb
+from dataset.tbm import get_tbm_dataset
+from segment_anything.utils.transforms import ResizeLongestSide
+from train import PRECISIONS, load_sam, load_model_emb, default_sam_setup, evaluate_subset
+from devices import get_device, setup_device
+
+
+def benchmark_size(image_size, args, sam_args, device):
+    # Dice, IoU and images/s of the test set with the SAM encoder running at image_size
+    sam = load_sam(sam_args, device, image_size, args['pack_grid']).eval()
+    args['embedding_size'] = sam.prompt_encoder.image_embedding_size[0]
+    model = setup_device(ModelEmb(args=args), device, int(args['num_threads']), args['memory_format'])
+    if args['path_best']:
+        model.load_state_dict(load_model_emb(args['path_best'], device, image_size, args['pack_grid']).state_dict())
+    model.eval()
+
+    _, testset = get_tbm_dataset(args, ResizeLongestSide(sam.image_encoder.img_size))
+    if args['num_images'] > 0:
+        testset = torch.utils.data.Subset(testset, range(min(args['num_images'], len(testset))))
+    ds = torch.utils.data.DataLoader(testset, batch_size=int(args['eval_batch_size']), shuffle=False,
+                                     num_workers=int(args['nW_eval']), drop_last=False)
+    with torch.inference_mode():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        dice, iou = evaluate_subset(ds, model, sam, int(args['Idim']), args['precision'])
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        seconds = time.perf_counter() - start
+    return dice, iou, len(testset) / seconds
+
+
+def main(args, sam_args):
+    device = get_device(args['device'], sam_args['gpu_id'])
+    # Unset flags take the SAM setup of the trained model, so it is benchmarked at the size it was trained with
+    trained = load_model_emb(args['path_best'], device, pack_grid=args['pack_grid']) if args['path_best'] else None
+    args['sam_image_size'] = None
+    default_sam_setup(args, trained)
+    if args['sam_image_sizes'] is None:
+        args['sam_image_sizes'] = [args['sam_image_size']] if trained is not None else [1024, 512, 256]
+    print('sam_image_size,dice,iou,images_per_s')
+    for image_size in args['sam_image_sizes']:
+        dice, iou, throughput = benchmark_size(image_size, args, sam_args, device)
+        print('{},{:.4f},{:.4f},{:.2f}'.format(image_size, dice, iou, throughput))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Accuracy and throughput of AutoSAM at several SAM input sizes')
+    parser.add_argument('--sam_image_sizes', type=int, nargs='+', default=None,
+                        help='Input sizes of the SAM image encoder to compare (default: the size --path_best was '
+                             'trained with, or 1024 512 256 for the untrained ModelEmb)')
+    parser.add_argument('--pack_grid', type=int, default=None,
+                        help='Encode pack_grid x pack_grid test images in one SAM forward at each size '
+                             '(default: the packing --path_best was trained with, else 1)')
+    parser.add_argument('--path_best', type=str, default=None,
+                        help='Trained ModelEmb (net_best.pth); without it the untrained ModelEmb is used')
+    parser.add_argument('--num_images', type=int, default=0, help='Number of test images (0: all)')
+    parser.add_argument('-nW_eval', '--nW_eval', default=0, help='evaluation iteration', required=False)
+    parser.add_argument('--eval_batch_size', type=int, default=4, help='Batch size of the evaluation')
+    parser.add_argument('-depth_wise', '--depth_wise', default=False, help='image size', required=False)
+    parser.add_argument('-order', '--order', default=85, help='image size', required=False)
+    parser.add_argument('-Idim', '--Idim', default=256, help='image size', required=False)
+    parser.add_argument('--train_data_root', type=str, required=True, help='Path to the training data root directory')
+    parser.add_argument('--test_data_root', type=str, required=True, help='Path to the testing data root directory')
+    parser.add_argument('--sam_checkpoint', type=str, help='Path to SAM checkpoint')
+    parser.add_argument('--model_type', type=str, default="vit_h", help='Model type for SAM (e.g., vit_h)')
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of the model and SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of CPU threads of torch (0: torch default)')
+    parser.add_argument('--memory_format', type=str, default='auto', choices=['auto', 'channels_last', 'contiguous'],
+                        help='Memory format of the model weights (auto: channels_last on CPU, contiguous on GPU)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Autocast precision of ModelEmb and SAM')
+    args = vars(parser.parse_args())
+    sam_args = {
+        'sam_checkpoint': args['sam_checkpoint'],
+        'model_type': args['model_type'],
+        'gpu_id': 0,
+    }
+    main(args, sam_args)
@@ -78,6 +78,7 @@ if __name__ == "__main__":
     import argparse
     import os
     from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
+    from devices import get_device
     from segment_anything.utils.transforms import ResizeLongestSide
 
     parser = argparse.ArgumentParser(description='Description of your program')
@@ -85,6 +86,8 @@ if __name__ == "__main__":
     parser.add_argument('-th_inter', '--th_inter', default=0, help='is load check point?', required=False)
     parser.add_argument('-K_fold', '--K_fold', default=False, help='is load check point?', required=False)
     parser.add_argument('-K', '--K', default=1, help='is load check point?', required=False)
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
     args = vars(parser.parse_args())
 
     sam_args = {
@@ -103,7 +106,7 @@ if __name__ == "__main__":
         'gpu_id': 0,
     }
     sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
-    sam.to(device=torch.device('cuda', sam_args['gpu_id']))
+    sam.to(device=get_device(args['device'], sam_args['gpu_id']))
     transform = ResizeLongestSide(sam.image_encoder.img_size)
     ds_train, ds_test = get_glas_dataset(transform)
     ds = torch.utils.data.DataLoader(ds_train,
@@ -168,6 +168,7 @@ if __name__ == '__main__':
     import argparse
     from matplotlib import pyplot as plt
     from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
+    from devices import get_device
     from segment_anything.utils.transforms import ResizeLongestSide
 
     parser = argparse.ArgumentParser(description='Description of your program')
@@ -176,6 +177,8 @@ if __name__ == '__main__':
     parser.add_argument('-scale1', '--scale1', default=0.75, help='learning_rate', required=False)
     parser.add_argument('-scale2', '--scale2', default=1.25, help='learning_rate', required=False)
     parser.add_argument('-rotate', '--rotate', default=20, help='learning_rate', required=False)
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
     args = vars(parser.parse_args())
 
     sam_args = {
@@ -194,7 +197,7 @@ if __name__ == '__main__':
         'gpu_id': 0,
     }
     sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
-    sam.to(device=torch.device('cuda', sam_args['gpu_id']))
+    sam.to(device=get_device(args['device'], sam_args['gpu_id']))
     sam_trans = ResizeLongestSide(sam.image_encoder.img_size)
 
     ds_train, ds_test = get_polyp_dataset(args, sam_trans=sam_trans)
@@ -26,7 +26,7 @@ def cv2_loader(path, is_mask):
 
 class ImageLoader(torch.utils.data.Dataset):
     def __init__(self, root, transform=None, target_transform=None, train=False, loader=cv2_loader,
-                 sam_trans=None, augmentation_factor=1):
+                 sam_trans=None, augmentation_factor=1, augmentation_slots=0, augmentation_seed=0):
         assert os.path.isdir(root), f'not a valid root: {root}'
         self.root = root
         self.imgs_root = os.path.join(self.root, 'images')
@@ -38,17 +38,33 @@ class ImageLoader(torch.utils.data.Dataset):
         self.loader = loader
         self.train = train
         self.augmentation_factor = augmentation_factor
+        # With K > 0 slots every image only takes K fixed augmentations, so their SAM embeddings can be cached
+        self.augmentation_slots = augmentation_slots
+        self.augmentation_seed = augmentation_seed
         self.sam_trans = sam_trans
         print('num of data:{}'.format(len(self.paths)))
 
-    def __getitem__(self, index):
+    def apply_transform(self, img, mask, file_path, slot=None):
+        if slot is None:
+            return self.transform(img, mask)
+        # The random parameters of a slot are drawn from a generator seeded by (seed, image, slot)
+        state = random.getstate()
+        random.seed('{}:{}:{}'.format(self.augmentation_seed, file_path, slot))
+        try:
+            return self.transform(img, mask)
+        finally:
+            random.setstate(state)
+
+    def __getitem__(self, index, slot=None):
         index = index % len(self.paths)
+        if slot is None and self.augmentation_slots > 0:
+            slot = random.randrange(self.augmentation_slots)
         file_path = self.paths[index]
         mask_path = file_path.split('.')[0] + '.png'
         img = self.loader(os.path.join(self.imgs_root, file_path), is_mask=False)
         mask = self.loader(os.path.join(self.masks_root, mask_path), is_mask=True)
         
-        img, mask = self.transform(img, mask)
+        img, mask = self.apply_transform(img, mask, file_path, slot)
         original_size = tuple(img.shape[1:3])
         img, mask = self.sam_trans.apply_image_torch(img), self.sam_trans.apply_image_torch(mask)
 
@@ -69,9 +85,25 @@ class ImageLoader(torch.utils.data.Dataset):
         return len(self.paths) * self.augmentation_factor
 
 
+class AugmentationSlots(torch.utils.data.Dataset):
+    # Every (image, slot) pair of an ImageLoader exactly once, to precompute the embeddings of all slots
+    def __init__(self, dataset):
+        assert dataset.augmentation_slots > 0, 'the dataset has no augmentation slots'
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset.__getitem__(index // self.dataset.augmentation_slots,
+                                        slot=index % self.dataset.augmentation_slots)
+
+    def __len__(self):
+        return len(self.dataset.paths) * self.dataset.augmentation_slots
+
+
 def get_tbm_dataset(args, sam_trans):
     transform_train, transform_test = get_tbm_transform()
-    ds_train = ImageLoader(args['train_data_root'], train=True, transform=transform_train, sam_trans=sam_trans, augmentation_factor=2)
+    ds_train = ImageLoader(args['train_data_root'], train=True, transform=transform_train, sam_trans=sam_trans, augmentation_factor=2,
+                           augmentation_slots=int(args.get('augmentation_slots', 0)),
+                           augmentation_seed=int(args.get('augmentation_seed', 0)))
     ds_test = ImageLoader(args['test_data_root'], train=False, transform=transform_test, sam_trans=sam_trans, augmentation_factor=1)
     print(f"Number of train images: {len(ds_train)}")
     print(f"Number of test images: {len(ds_test)}")
@@ -83,6 +115,7 @@ if __name__ == "__main__":
     import argparse
     import os
     from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
+    from devices import get_device
     from segment_anything.utils.transforms import ResizeLongestSide
 
     parser = argparse.ArgumentParser(description='Description of your program')
@@ -91,6 +124,8 @@ if __name__ == "__main__":
     parser.add_argument('-scale1', '--scale1', default=0.75, help='Scale factor 1', required=False)
     parser.add_argument('-scale2', '--scale2', default=1.25, help='Scale factor 2', required=False)
     parser.add_argument('-rotate', '--rotate', default=20, help='Rotation factor', required=False)
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
     args = vars(parser.parse_args())
 
     sam_args = {
@@ -109,7 +144,7 @@ if __name__ == "__main__":
         'gpu_id': 0,
     }
     sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
-    sam.to(device=torch.device('cuda', sam_args['gpu_id']))
+    sam.to(device=get_device(args['device'], sam_args['gpu_id']))
     sam_trans = ResizeLongestSide(sam.image_encoder.img_size)
     ds_train, ds_test = get_tbm_dataset(args, sam_trans)
     ds = torch.utils.data.DataLoader(ds_train,
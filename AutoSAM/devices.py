@@ -0,0 +1,20 @@
+import torch
+
+
+def get_device(name='auto', gpu_id=0):
+    # 'auto' takes the GPU when there is one, so the same command runs on GPU and CPU-only nodes
+    if name == 'auto':
+        name = 'cuda:{}'.format(gpu_id) if torch.cuda.is_available() else 'cpu'
+    return torch.device(name)
+
+
+def setup_device(model, device, num_threads=0, memory_format='auto'):
+    # Moves the model to the device; on CPU, convolutions in channels_last (NHWC) layout run faster with oneDNN
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if memory_format == 'auto':
+        memory_format = 'channels_last' if device.type == 'cpu' else 'contiguous'
+    model = model.to(device)
+    if memory_format == 'channels_last':
+        model = model.to(memory_format=torch.channels_last)
+    return model
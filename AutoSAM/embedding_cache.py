@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+
+EMBEDDING_SHAPE = (256, 64, 64)  # SAM image embedding of one 1024x1024 input
+DATA_FILENAME = 'embeddings.npy'
+INDEX_FILENAME = 'index.json'
+RANDOM_TRANSFORMS = ('ColorJitter',)  # Random transforms whose name does not start with Random
+
+
+def is_deterministic(transform):
+    # A dataset transform is deterministic if none of its steps draws random numbers
+    if transform is None:  # Datasets without a known transform are treated as random
+        return False
+    transforms = getattr(transform, 'transforms', [transform])
+    return not any(type(t).__name__.startswith('Random') or type(t).__name__ in RANDOM_TRANSFORMS
+                   for t in transforms)
+
+
+def sam_tag(sam_args):
+    # Identifies the frozen image encoder, embeddings of another checkpoint are never reused
+    checkpoint = sam_args['sam_checkpoint']
+    size = os.path.getsize(checkpoint) if checkpoint and os.path.exists(checkpoint) else 0
+    return '{}:{}:{}'.format(sam_args['model_type'], os.path.basename(str(checkpoint)), size)
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of frozen SAM image embeddings, stored as rows of one memory-mapped float16 .npy file.
+    Rows are keyed by a hash of the encoder input, i.e. of the image after the dataset and SAM transforms,
+    so the key changes with the image content as well as with any transform parameter.
+    """
+
+    def __init__(self, root, tag, shape=EMBEDDING_SHAPE):
+        self.root = root
+        self.tag = tag
+        self.shape = tuple(shape)
+        self.data_path = os.path.join(root, DATA_FILENAME)
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        self.index = {}
+        self.data = None
+        os.makedirs(root, exist_ok=True)
+
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path) as f:
+                meta = json.load(f)
+            if meta['tag'] == tag and tuple(meta['shape']) == self.shape:
+                self.index = meta['keys']
+                self.data = np.load(self.data_path, mmap_mode='r+')
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, image):
+        digest = hashlib.sha256(self.tag.encode())
+        digest.update(str(tuple(image.shape)).encode())
+        digest.update(image.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _reserve(self, count):
+        # Grow the file geometrically, copying the filled rows into a new memory map
+        needed = len(self.index) + count
+        capacity = 0 if self.data is None else len(self.data)
+        if needed <= capacity:
+            return
+        tmp_path = self.data_path + '.tmp'
+        data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                         shape=(max(needed, 2 * capacity, 64),) + self.shape)
+        if self.data is not None:
+            data[:len(self.index)] = self.data[:len(self.index)]
+        data.flush()
+        del data
+        self.data = None
+        os.replace(tmp_path, self.data_path)
+        self.data = np.load(self.data_path, mmap_mode='r+')
+
+    def put(self, keys, embeddings):
+        new = [(key, embedding) for key, embedding in zip(keys, embeddings) if key not in self.index]
+        if not new:
+            return
+        self._reserve(len(new))
+        for key, embedding in new:
+            if key in self.index:  # The same input twice in one batch
+                continue
+            row = len(self.index)
+            self.data[row] = embedding.detach().float().cpu().numpy().astype(np.float16)
+            self.index[key] = row
+        self.data.flush()
+
+        # The index is written after the rows, so a crash never leaves keys pointing at unwritten rows
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'tag': self.tag, 'shape': list(self.shape), 'keys': self.index}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get_or_compute(self, images, compute):
+        """
+        Returns the float32 embeddings of a batch of encoder inputs. compute(indices) is only called
+        for the images of the batch that are not cached yet, and must return their embeddings.
+        """
+        keys = [self.key(image) for image in images]
+        missing = [i for i, key in enumerate(keys) if key not in self.index]
+        if missing:
+            self.put([keys[i] for i in missing], compute(missing))
+        rows = [self.index[key] for key in keys]
+        return torch.from_numpy(np.asarray(self.data[rows], dtype=np.float32))
@@ -0,0 +1,116 @@
+import os
+import sys
+import torch
+from models.model_single import ModelEmb
+from segment_anything.utils.onnx import AutoSamOnnxModel
+from train import get_input_dict, norm_batch, sam_call, load_sam, load_model_emb, default_sam_setup
+from devices import setup_device
+
+EXPORT_BATCH_SIZE = 2  # Batch size of the example inputs; the batch dimension of the graph stays dynamic
+
+
+def example_inputs(sam, batch_size, include_image_encoder):
+    size = sam.image_encoder.img_size
+    images = torch.randn((batch_size, 3, size, size))
+    if include_image_encoder:
+        return (images,)
+    embedding_size = sam.prompt_encoder.image_embedding_size
+    return images, torch.randn((batch_size, sam.prompt_encoder.embed_dim, *embedding_size))
+
+
+def export_onnx(onnx_model, inputs, output_path, opset):
+    input_names = ['images', 'image_embeddings'][:len(inputs)]
+    dynamic_axes = {name: {0: 'batch_size'} for name in input_names + ['masks']}
+    torch.onnx.export(onnx_model, inputs, output_path, input_names=input_names, output_names=['masks'],
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+
+
+def export_torchscript(onnx_model, inputs, output_path):
+    traced = torch.jit.trace(onnx_model, inputs, check_trace=False)
+    traced.save(output_path)
+
+
+def run_exported(output_path, export_format, inputs):
+    if export_format == 'onnx':
+        from onnx_runtime import AutoSamOnnxSession
+        session = AutoSamOnnxSession(output_path)
+        return torch.from_numpy(session.predict(*[x.numpy() for x in inputs]))
+    with torch.inference_mode():
+        return torch.jit.load(output_path)(*inputs)
+
+
+def check_parity(output_path, export_format, model, sam, Idim, include_image_encoder, batch_size):
+    # Compares the exported graph with the PyTorch path of inference.py, at another batch size than the export
+    inputs = example_inputs(sam, batch_size, include_image_encoder)
+    images = inputs[0]
+    sizes = torch.Tensor([[sam.image_encoder.img_size] * 2] * batch_size)
+    with torch.inference_mode():
+        images_small = torch.nn.functional.interpolate(images, (Idim, Idim), mode='bilinear', align_corners=True)
+        image_embeddings = None if include_image_encoder else inputs[1]
+        expected = norm_batch(sam_call(get_input_dict(images, sizes, sizes), sam, model(images_small), image_embeddings))
+    exported = run_exported(output_path, export_format, inputs)
+    return (exported - expected).abs().max().item()
+
+
+def main(args, sam_args):
+    # Exported on the CPU in float32 and the default memory format, the graph can be run anywhere
+    device = torch.device('cpu')
+    # The exported graph encodes one image per forward, so only unpacked models are exported
+    trained = load_model_emb(args['path_best'], device, args['sam_image_size'], pack_grid=1)
+    default_sam_setup(args, trained)
+    sam = load_sam(sam_args, device, int(args['sam_image_size'])).eval()
+    args['embedding_size'] = sam.prompt_encoder.image_embedding_size[0]
+    model = setup_device(ModelEmb(args=args), device, memory_format='contiguous')
+    model.load_state_dict(trained.state_dict())
+    model.eval()
+
+    include_image_encoder = not args['no_image_encoder']
+    onnx_model = AutoSamOnnxModel(model, sam, int(args['Idim']), include_image_encoder).eval()
+    inputs = example_inputs(sam, EXPORT_BATCH_SIZE, include_image_encoder)
+    os.makedirs(os.path.dirname(os.path.abspath(args['output'])), exist_ok=True)
+    if args['format'] == 'onnx':
+        export_onnx(onnx_model, inputs, args['output'], args['opset'])
+    else:
+        export_torchscript(onnx_model, inputs, args['output'])
+    print('Exported {} to {}'.format(args['format'], args['output']))
+
+    if args['parity_batch_size'] > 0:
+        max_diff = check_parity(args['output'], args['format'], model, sam, int(args['Idim']),
+                                include_image_encoder, args['parity_batch_size'])
+        print('Parity check, largest mask difference to PyTorch: {:.2e}'.format(max_diff))
+        if max_diff > args['tolerance']:
+            sys.exit('The exported graph differs from PyTorch by more than {}'.format(args['tolerance']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Export a trained ModelEmb and the SAM mask decoder as one graph')
+    parser.add_argument('-folder', '--folder', default=6, help='Run folder results/gpu<folder> of the trained model', required=False)
+    parser.add_argument('--output', type=str, default=None,
+                        help='Path of the exported graph (default: results/gpu<folder>/autosam.onnx or .pt)')
+    parser.add_argument('--format', type=str, default='onnx', choices=['onnx', 'torchscript'], help='Export format')
+    parser.add_argument('--no_image_encoder', action='store_true',
+                        help='Leave the SAM image encoder out of the graph, which then takes precomputed image embeddings')
+    parser.add_argument('--opset', type=int, default=18, help='ONNX opset version')
+    parser.add_argument('--parity_batch_size', type=int, default=3,
+                        help='Batch size of the parity check against PyTorch (0: no check)')
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='Largest mask difference to PyTorch accepted by the parity check')
+    parser.add_argument('-depth_wise', '--depth_wise', default=False, help='image size', required=False)
+    parser.add_argument('-order', '--order', default=85, help='image size', required=False)
+    parser.add_argument('-Idim', '--Idim', default=256, help='image size', required=False)
+    parser.add_argument('--sam_checkpoint', type=str, help='Path to SAM checkpoint')
+    parser.add_argument('--model_type', type=str, default="vit_h", help='Model type for SAM (e.g., vit_h)')
+    parser.add_argument('--sam_image_size', type=int, default=None,
+                        help='Input size of the SAM image encoder (default: the size the model was trained with)')
+    args = vars(parser.parse_args())
+    args['path_best'] = os.path.join('results', 'gpu' + str(args['folder']), 'net_best.pth')
+    if args['output'] is None:
+        extension = '.onnx' if args['format'] == 'onnx' else '.pt'
+        args['output'] = os.path.join('results', 'gpu' + str(args['folder']), 'autosam' + extension)
+    sam_args = {
+        'sam_checkpoint': args['sam_checkpoint'],
+        'model_type': args['model_type'],
+        'gpu_id': 0,
+    }
+    main(args, sam_args)
@@ -5,16 +5,71 @@ from models.model_single import ModelEmb
 from dataset.glas import get_glas_dataset
 from dataset.MoNuBrain import get_monu_dataset
 from dataset.polyp import get_polyp_dataset, get_tests_polyp_dataset
-from dataset.tbm import get_tbm_dataset
+from dataset.tbm import get_tbm_dataset, cv2_loader
 from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
 from segment_anything.utils.transforms import ResizeLongestSide
 from tqdm import tqdm
 import torch.nn.functional as F
 import numpy as np
-from train import get_input_dict, norm_batch, get_dice_ji
+from train import get_input_dict, norm_batch, get_dice_ji_batch, postprocess_batch
+from devices import get_device, setup_device
+from train import PRECISIONS, precision_context, check_precision, load_sam, load_model_emb, default_sam_setup
 import cv2
+import math
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from cv_algorithms import guo_hall
 
+WRITER_THREADS = 4  # Threads thinning and writing the masks of finished batches
+MAX_PENDING_BATCHES = 4  # Batches waiting for post-processing before the model blocks
+
+
+def thin_mask(mask_np):
+    # Otsu threshold and Guo-Hall thinning of a 0..255 mask
+    _, mask_np_thresh = cv2.threshold(mask_np.astype(np.uint8), 0, 255, cv2.THRESH_OTSU)
+    guo_hall(mask_np_thresh, inplace=True)
+    return mask_np_thresh
+
+
+def thin_gt_mask(gt_mask_np, gt_cache_dir):
+    # The thinned GT only depends on the resized GT mask, so it is computed once per dataset and cached by content
+    if gt_cache_dir is None:
+        return thin_mask(gt_mask_np), None
+    key = hashlib.sha256(str(gt_mask_np.shape).encode() + np.ascontiguousarray(gt_mask_np).tobytes()).hexdigest()
+    cache_path = os.path.join(gt_cache_dir, key + '.png')
+    if os.path.exists(cache_path):
+        return cv2.imread(cache_path, cv2.IMREAD_GRAYSCALE), cache_path
+    gt_mask_np_thresh = thin_mask(gt_mask_np)
+    tmp_path = os.path.join(gt_cache_dir, '{}.{}.tmp.png'.format(key, threading.get_ident()))
+    cv2.imwrite(tmp_path, gt_mask_np_thresh)
+    os.replace(tmp_path, cache_path)
+    return gt_mask_np_thresh, cache_path
+
+
+def thin_and_write_batch(filenames, pred_masks_np, gt_masks_np, pred_masks_folder, gt_masks_folder, gt_cache_dir):
+    thinned_preds, thinned_gts = [], []
+    for filename, pred_mask_np, gt_mask_np in zip(filenames, pred_masks_np, gt_masks_np):
+        # Threshold and apply Guo-Hall thinning to the predicted mask
+        pred_mask_np_thresh = thin_mask(pred_mask_np)
+        cv2.imwrite(os.path.join(pred_masks_folder, "thinned_" + filename), pred_mask_np_thresh)
+
+        # Threshold and apply Guo-Hall thinning to the ground truth mask, or copy it from the cache
+        gt_mask_np_thresh, cache_path = thin_gt_mask(gt_mask_np, gt_cache_dir)
+        gt_mask_path_thinned = os.path.join(gt_masks_folder, "thinned_" + filename)
+        if cache_path:
+            shutil.copyfile(cache_path, gt_mask_path_thinned)
+        else:
+            cv2.imwrite(gt_mask_path_thinned, gt_mask_np_thresh)
+        thinned_preds.append(pred_mask_np_thresh)
+        thinned_gts.append(gt_mask_np_thresh)
+
+    # Dice and IoU of the whole batch of thinned masks in one reduction
+    dice, ji = get_dice_ji_batch(torch.from_numpy(np.stack(thinned_preds) / 255),
+                                 torch.from_numpy(np.stack(thinned_gts) / 255))
+    return filenames, dice.tolist(), ji.tolist()
+
 
 
 def inference_ds(ds, model, sam, transform, epoch, args):
@@ -27,42 +82,16 @@ def inference_ds(ds, model, sam, transform, epoch, args):
     iou_list = []
     dice_list = []
     Idim = int(args['Idim'])
-    for ix, (imgs, gts, original_sz, img_sz, filename) in enumerate(pbar):
-        filename = filename[0]
-        orig_imgs = imgs.to(sam.device)
-        gts = gts.to(sam.device)
-        orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
-        dense_embeddings = model(orig_imgs_small)
-        batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
-        masks = norm_batch(sam_call(batched_input, sam, dense_embeddings))
-        input_size = tuple([int(x) for x in img_sz[0].squeeze().tolist()])
-        original_size = tuple([int(x) for x in original_sz[0].squeeze().tolist()])
-        masks = sam.postprocess_masks(masks, input_size=input_size, original_size=original_size)
-        gts = sam.postprocess_masks(gts.unsqueeze(dim=0), input_size=input_size, original_size=original_size)
-        masks = F.interpolate(masks, (Idim, Idim), mode='bilinear', align_corners=True)
-        gts = F.interpolate(gts, (Idim, Idim), mode='nearest')
-        masks[masks > 0.5] = 1
-        masks[masks <= 0.5] = 0
-
-        pred_mask_np = masks.squeeze().detach().cpu().numpy() * 255  
-        gt_mask_np = gts.squeeze().detach().cpu().numpy() * 255  
-        # Threshold and apply Guo-Hall thinning to the predicted mask
-        _, pred_mask_np_thresh = cv2.threshold(pred_mask_np.astype(np.uint8), 0, 255, cv2.THRESH_OTSU)
-        guo_hall(pred_mask_np_thresh, inplace=True)
-
-        # Threshold and apply Guo-Hall thinning to the ground truth mask
-        _, gt_mask_np_thresh = cv2.threshold(gt_mask_np.astype(np.uint8), 0, 255, cv2.THRESH_OTSU)
-        guo_hall(gt_mask_np_thresh, inplace=True)
-        pred_mask_path_thinned = os.path.join(pred_masks_folder, "thinned_" + filename)
-        gt_mask_path_thinned = os.path.join(gt_masks_folder, "thinned_" + filename)
-        cv2.imwrite(pred_mask_path_thinned, pred_mask_np_thresh)
-        cv2.imwrite(gt_mask_path_thinned, gt_mask_np_thresh)
-
-        dice, ji = get_dice_ji(pred_mask_np_thresh / 255, gt_mask_np_thresh / 255)
-        print(f"Image: {filename}, Post-thinning Dice: {dice:.4f}, Post-thinning IoU: {ji:.4f}")
-        iou_list.append(ji)
-        dice_list.append(dice)
+    gt_cache_dir = args.get('gt_cache_dir')
+    if gt_cache_dir:
+        os.makedirs(gt_cache_dir, exist_ok=True)
 
+    def report(future):
+        filenames, dice, ji = future.result()
+        for filename, image_dice, image_ji in zip(filenames, dice, ji):
+            print(f"Image: {filename}, Post-thinning Dice: {image_dice:.4f}, Post-thinning IoU: {image_ji:.4f}")
+        iou_list.extend(ji)
+        dice_list.extend(dice)
         pbar.set_description(
             '(Inference | {task}) Epoch {epoch} :: Dice {dice:.4f} :: IoU {iou:.4f}'.format(
                 task=args['task'],
@@ -72,6 +101,39 @@ def inference_ds(ds, model, sam, transform, epoch, args):
             )
         )
 
+    # Thinning and writing run on a writer pool while the model works on the next batch;
+    # the semaphore bounds the batches waiting there
+    pending = threading.BoundedSemaphore(MAX_PENDING_BATCHES)
+    futures = []
+    writers = ThreadPoolExecutor(max_workers=int(args.get('writer_threads', WRITER_THREADS)))
+    for ix, (imgs, gts, original_sz, img_sz, filenames) in enumerate(pbar):
+        orig_imgs = imgs.to(sam.device)
+        gts = gts.to(sam.device)
+        orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
+        with precision_context(sam.device, args['precision']):
+            dense_embeddings = model(orig_imgs_small)
+            batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
+            masks = norm_batch(sam_call(batched_input, sam, dense_embeddings))
+        masks, gts = postprocess_batch(masks, gts, sam, original_sz, img_sz, Idim)
+        masks[masks > 0.5] = 1
+        masks[masks <= 0.5] = 0
+
+        pred_masks_np = masks.squeeze(dim=1).detach().cpu().numpy() * 255
+        gt_masks_np = gts.squeeze(dim=1).detach().cpu().numpy() * 255
+        pending.acquire()
+        future = writers.submit(thin_and_write_batch, list(filenames), pred_masks_np, gt_masks_np,
+                                pred_masks_folder, gt_masks_folder, gt_cache_dir)
+        future.add_done_callback(lambda _: pending.release())
+        futures.append(future)
+
+        # Report finished batches in order, without waiting for the others
+        while futures and futures[0].done():
+            report(futures.pop(0))
+
+    for future in futures:
+        report(future)
+    writers.shutdown()
+
     model.train()
     final_mean_dice = np.mean(dice_list)
     final_mean_iou = np.mean(iou_list)
@@ -91,18 +153,100 @@ def sam_call(batched_input, sam, dense_embeddings):
         dense_prompt_embeddings=dense_embeddings,
         multimask_output=False,
     )
-    return low_res_masks
+    # Masks leave in float32 whatever the autocast precision
+    return low_res_masks.float()
+
+
+
+def tile_positions(extent, tile_size, stride):
+    # Tile origins along one axis; the last tile is aligned to the image border so the whole image is covered
+    if extent <= tile_size:
+        return [0]
+    positions = list(range(0, extent - tile_size + 1, stride))
+    if positions[-1] != extent - tile_size:
+        positions.append(extent - tile_size)
+    return positions
+
+
+def blending_window(tile_size, device):
+    # sin^2 window, highest at the tile center and small but nonzero at its borders, so overlaps blend without seams
+    ramp = torch.sin(math.pi * (torch.arange(tile_size, device=device) + 0.5) / tile_size) ** 2
+    return ramp[:, None] * ramp[None, :]
 
 
+def prepare_tile(tile, sam_trans):
+    # Same input as ImageLoader with the test transform: resize the longest side, normalize and pad
+    img = torch.Tensor(tile).permute(2, 0, 1).float()
+    original_size = tuple(img.shape[1:3])
+    img = sam_trans.apply_image_torch(img)
+    image_size = tuple(img.shape[1:3])
+    return sam_trans.preprocess(img), torch.Tensor(original_size), torch.Tensor(image_size)
+
+
+def predict_tiles(imgs, original_sz, img_sz, model, sam, Idim, precision='fp32'):
+    orig_imgs = imgs.to(sam.device)
+    orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
+    with precision_context(sam.device, precision):
+        dense_embeddings = model(orig_imgs_small)
+        batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
+        masks = norm_batch(sam_call(batched_input, sam, dense_embeddings))
+    # All tiles of a batch have the same size
+    input_size = tuple([int(x) for x in img_sz[0].squeeze().tolist()])
+    original_size = tuple([int(x) for x in original_sz[0].squeeze().tolist()])
+    return sam.postprocess_masks(masks, input_size=input_size, original_size=original_size)[:, 0]
+
+
+def infer_full_image(image, model, sam, sam_trans, Idim, tile_size, stride, batch_size, precision='fp32'):
+    height, width = image.shape[:2]
+    # Images smaller than a tile are mirrored up to the tile size
+    pad_h, pad_w = max(0, tile_size - height), max(0, tile_size - width)
+    if pad_h or pad_w:
+        image = np.pad(image, ((0, pad_h), (0, pad_w), (0, 0)), mode='reflect')
+
+    window = blending_window(tile_size, sam.device)
+    probs_sum = torch.zeros(image.shape[:2], device=sam.device)
+    weights_sum = torch.zeros(image.shape[:2], device=sam.device)
+    positions = [(y, x) for y in tile_positions(image.shape[0], tile_size, stride)
+                 for x in tile_positions(image.shape[1], tile_size, stride)]
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        tiles = [prepare_tile(image[y:y + tile_size, x:x + tile_size], sam_trans) for y, x in batch]
+        imgs, original_sz, img_sz = (torch.stack(values) for values in zip(*tiles))
+        probs = predict_tiles(imgs, original_sz, img_sz, model, sam, Idim, precision)
+        for (y, x), prob in zip(batch, probs):
+            probs_sum[y:y + tile_size, x:x + tile_size] += prob * window
+            weights_sum[y:y + tile_size, x:x + tile_size] += window
+    return (probs_sum / weights_sum)[:height, :width]
+
+
+def inference_full_images(image_dir, output_dir, model, sam, sam_trans, args):
+    # Segment whole micrographs tile by tile and write every stitched probability map once
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.tif')))
+    for filename in tqdm(filenames):
+        image = cv2_loader(os.path.join(image_dir, filename), is_mask=False)
+        prob = infer_full_image(image, model, sam, sam_trans, int(args['Idim']), int(args['tile_size']),
+                                int(args['stride']), int(args['tile_batch_size']), args['precision'])
+        prob_np = (prob.clamp(0, 1).cpu().numpy() * 255).round().astype(np.uint8)
+        cv2.imwrite(os.path.join(output_dir, os.path.splitext(filename)[0] + '.png'), prob_np)
+
 
 def main(args=None, sam_args=None):
-    model = ModelEmb(args=args).cuda()
-    model1 = torch.load(args['path_best'])
+    device = get_device(args['device'], sam_args['gpu_id'])
+    model1 = load_model_emb(args['path_best'], device, args['sam_image_size'], args['pack_grid'])
+    default_sam_setup(args, model1)
+    sam = load_sam(sam_args, device, int(args['sam_image_size']), int(args['pack_grid']))
+    args['embedding_size'] = sam.prompt_encoder.image_embedding_size[0]
+    model = setup_device(ModelEmb(args=args), device, int(args['num_threads']), args['memory_format'])
     model.load_state_dict(model1.state_dict())
-    sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
-    sam.to(device=torch.device('cuda', sam_args['gpu_id']))
     transform = ResizeLongestSide(sam.image_encoder.img_size)
 
+    if args['full_image_dir']:
+        with torch.inference_mode():
+            model.eval()
+            inference_full_images(args['full_image_dir'], args['full_output_dir'], model, sam, transform, args)
+        return
+
     if args['task'] == 'monu':
         trainset, testset = get_monu_dataset(args, sam_trans=transform)
     elif args['task'] == 'glas':
@@ -111,9 +255,10 @@ def main(args=None, sam_args=None):
         trainset, testset = get_polyp_dataset(args, sam_trans=transform)
     elif args['task'] == 'tbm':
          trainset, testset = get_tbm_dataset(args, sam_trans=transform)
-    ds_val = torch.utils.data.DataLoader(testset, batch_size=1, shuffle=False,
+    ds_val = torch.utils.data.DataLoader(testset, batch_size=int(args['eval_batch_size']), shuffle=False,
                                          num_workers=int(args['nW_eval']), drop_last=False)
-    with torch.no_grad():
+    args['precision'] = check_precision(testset, model, sam, args)
+    with torch.inference_mode():
         model.eval()
         inference_ds(ds_val, model.eval(), sam, transform, 0, args)
 
@@ -123,6 +268,12 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Description of your program')
     parser.add_argument('-nW_eval', '--nW_eval', default=0, help='evaluation iteration', required=False)
+    parser.add_argument('--eval_batch_size', type=int, default=4, help='Batch size of the inference')
+    parser.add_argument('--writer_threads', type=int, default=WRITER_THREADS,
+                        help='Number of threads thinning and writing the predicted and GT masks')
+    parser.add_argument('--gt_cache_dir', type=str, default=os.path.join('results', 'gt_thinning_cache'),
+                        help='Directory caching the thinned GT masks, so they are only thinned once per dataset')
+    parser.add_argument('--no_gt_cache', action='store_true', help='Thin the GT masks on every run')
     parser.add_argument('-task', '--task', default='tbm', help='evaluation iteration', required=False)
     parser.add_argument('-depth_wise', '--depth_wise', default=False, help='image size', required=False)
     parser.add_argument('-order', '--order', default=85, help='image size', required=False)
@@ -131,16 +282,47 @@ if __name__ == '__main__':
     parser.add_argument('-rotate', '--rotate', default=22, help='image size', required=False)
     parser.add_argument('-scale1', '--scale1', default=0.75, help='image size', required=False)
     parser.add_argument('-scale2', '--scale2', default=1.25, help='image size', required=False)
-    parser.add_argument('--train_data_root', type=str, required=True, help='Path to the training data root directory')
-    parser.add_argument('--test_data_root', type=str, required=True, help='Path to the testing data root directory')
+    parser.add_argument('--train_data_root', type=str, help='Path to the training data root directory')
+    parser.add_argument('--test_data_root', type=str, help='Path to the testing data root directory')
     parser.add_argument('--sam_checkpoint', type=str, help='Path to SAM checkpoint')
     parser.add_argument('--model_type', type=str, default="vit_h", help='Model type for SAM (e.g., vit_h)')
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of the model and SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of CPU threads of torch (0: torch default)')
+    parser.add_argument('--memory_format', type=str, default='auto', choices=['auto', 'channels_last', 'contiguous'],
+                        help='Memory format of the model weights (auto: channels_last on CPU, contiguous on GPU)')
+    parser.add_argument('--sam_image_size', type=int, default=None,
+                        help='Input size of the SAM image encoder (default: the size the model was trained with)')
+    parser.add_argument('--pack_grid', type=int, default=None,
+                        help='Encode pack_grid x pack_grid images in one SAM forward, each resized to sam_image_size / pack_grid '
+                             '(default: the packing the model was trained with)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Autocast precision of ModelEmb and SAM (mixed: bf16 on CPU and recent GPUs, else fp16)')
+    parser.add_argument('--precision_check_size', type=int, default=16,
+                        help='Number of test images on which a reduced precision is compared with fp32 (0: no check)')
+    parser.add_argument('--precision_tolerance', type=float, default=0.01,
+                        help='Largest Dice/IoU loss of the reduced precision before falling back to fp32')
+    parser.add_argument('--full_image_dir', type=str, default=None,
+                        help='Segment the whole images of this directory with tiled sliding-window inference instead of the test set')
+    parser.add_argument('--full_output_dir', type=str, default=None,
+                        help='Where to write the stitched probability maps (default: <vis folder>/full_predictions)')
+    parser.add_argument('--tile_size', type=int, default=256, help='Size of the square tiles of the full-image inference')
+    parser.add_argument('--stride', type=int, default=128, help='Stride between tiles of the full-image inference')
+    parser.add_argument('--tile_batch_size', type=int, default=8, help='Number of tiles run through the model at once')
     args = vars(parser.parse_args())
+    if args['no_gt_cache']:
+        args['gt_cache_dir'] = None
+    if not args['full_image_dir'] and not (args['train_data_root'] and args['test_data_root']):
+        parser.error('--train_data_root and --test_data_root are required without --full_image_dir')
+    if not 0 < args['stride'] <= args['tile_size']:
+        parser.error('--stride must be between 1 and --tile_size, so the tiles cover the whole image')
     args['path_best'] = os.path.join('results',
                                      'gpu' + str(args['folder']),
                                      'net_best.pth')
     args['vis_folder'] = os.path.join('results', 'gpu' + str(args['folder']), 'vis')
     os.makedirs(args['vis_folder'], exist_ok=True)
+    if args['full_output_dir'] is None:
+        args['full_output_dir'] = os.path.join(args['vis_folder'], 'full_predictions')
 
     sam_args = {
     'sam_checkpoint': args['sam_checkpoint'],
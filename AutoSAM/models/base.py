@@ -113,9 +113,9 @@ class MMDecoder(nn.Module):
         super(MMDecoder, self).__init__()
         self.bottleneck = BottleneckBlock(full_features[4], z_size)
         self.up0 = UpBlock(z_size, full_features[3],
-                           func='relu', drop=0).cuda()
+                           func='relu', drop=0)
         self.up1 = UpBlock(full_features[3], out_channel,
-                           func='None', drop=0).cuda()
+                           func='None', drop=0)
         self.out_size = out_size
 
     def forward(self, z, z_text):
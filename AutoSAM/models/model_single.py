@@ -8,11 +8,11 @@ class Decoder(nn.Module):
         # self.up1 = UpBlockSkip(full_features[4] + full_features[3], full_features[3],
         #                        func='relu', drop=0).cuda()
         self.up1 = UpBlockSkip(full_features[3] + full_features[2], full_features[2],
-                               func='relu', drop=0).cuda()
+                               func='relu', drop=0)
         self.up2 = UpBlockSkip(full_features[2] + full_features[1], full_features[1],
-                               func='relu', drop=0).cuda()
+                               func='relu', drop=0)
         self.up3 = UpBlockSkip(full_features[1] + full_features[0], full_features[0],
-                               func='relu', drop=0).cuda()
+                               func='relu', drop=0)
         self.Upsample = nn.Upsample(scale_factor=2, mode='bilinear')
         self.final = CNNBlock(full_features[0], out, kernel_size=3, drop=0)
 
@@ -99,11 +99,12 @@ class Model(nn.Module):
         y = torch.arange(nP, nP**2, nP).long()
         grid_x, grid_y = torch.meshgrid(x, y, indexing='ij')
         P = torch.cat((grid_x.unsqueeze(dim=0), grid_y.unsqueeze(dim=0)), dim=0)
-        P = P.view(2, -1).permute(1, 0).cuda()
-        self.P = (P - half) / half
+        P = P.view(2, -1).permute(1, 0)
+        # Buffers follow the model to its device, and are not part of the state dict
+        self.register_buffer('P', (P - half) / half, persistent=False)
         pos_labels = torch.ones(P.shape[-2])
         neg_labels = torch.zeros(P.shape[-2])
-        self.labels = torch.cat((pos_labels, neg_labels)).cuda().unsqueeze(dim=0)
+        self.register_buffer('labels', torch.cat((pos_labels, neg_labels)).unsqueeze(dim=0), persistent=False)
 
     def forward(self, img, size=None):
         if size is None:
@@ -134,13 +135,16 @@ class ModelEmb(nn.Module):
         self.backbone = HarDNet(depth_wise=bool(int(args['depth_wise'])), arch=int(args['order']), args=args)
         d, f = self.backbone.full_features, self.backbone.features
         self.decoder = SmallDecoder(d, out=256)
+        # Side of the SAM image embedding grid, 64 for the 1024x1024 encoder input
+        self.embedding_size = int(args.get('embedding_size', 64))
         for param in self.backbone.parameters():
             param.requires_grad = True
 
     def forward(self, img, size=None):
         z = self.backbone(img)
         dense_embeddings = self.decoder(z)
-        dense_embeddings = F.interpolate(dense_embeddings, (64, 64), mode='bilinear', align_corners=True)
+        dense_embeddings = F.interpolate(dense_embeddings, (self.embedding_size, self.embedding_size),
+                                         mode='bilinear', align_corners=True)
         return dense_embeddings
 
 
@@ -247,7 +251,8 @@ if __name__ == "__main__":
     #     'gpu_id': 0,
     # }
 
-    model = ModelH().cuda()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = ModelH().to(device)
     # x = torch.randn((3, 3, 256, 256)).cuda()
     # P = model(x)
     # sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
@@ -260,7 +265,7 @@ if __name__ == "__main__":
     # model.conv2.load_state_dict(pretrain[3].state_dict())
     # model.norm2.load_state_dict(pretrain[4].state_dict())
     # model.conv3.load_state_dict(pretrain[6].state_dict())
-    x = torch.randn((4, 256, 64, 64)).cuda()
+    x = torch.randn((4, 256, 64, 64), device=device)
     z = model(x)
     print(z.shape)
 
@@ -36,8 +36,9 @@ class VGG16(nn.Module):
 
 
 if __name__ == "__main__":
-    model = VGG16Net().cuda()
-    x = torch.randn((16, 3, 304, 304)).cuda()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = VGG16Net().to(device)
+    x = torch.randn((16, 3, 304, 304), device=device)
     z = model(x)
     print(z.shape)
     # for item in z:
@@ -0,0 +1,32 @@
+import numpy as np
+import onnxruntime as ort
+
+
+class AutoSamOnnxSession:
+    """
+    Runs an AutoSAM graph exported by export_model.py with onnxruntime, without torch or the model code.
+    The images are the encoder inputs of the PyTorch path: resized by ResizeLongestSide, normalized and padded.
+    """
+
+    def __init__(self, path, num_threads=0, providers=('CPUExecutionProvider',)):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=list(providers))
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    @property
+    def needs_image_embeddings(self):
+        # Graphs exported without the image encoder take precomputed SAM image embeddings
+        return 'image_embeddings' in self.input_names
+
+    def predict(self, images, image_embeddings=None):
+        """
+        Returns the normalized low resolution masks (B x 1 x h x w) of a batch of images (B x 3 x S x S).
+        """
+        feeds = {'images': np.ascontiguousarray(images, dtype=np.float32)}
+        if self.needs_image_embeddings:
+            assert image_embeddings is not None, 'the graph was exported without the image encoder'
+            feeds['image_embeddings'] = np.ascontiguousarray(image_embeddings, dtype=np.float32)
+        return self.session.run(['masks'], feeds)[0]
@@ -8,7 +8,7 @@ import torch
 
 from functools import partial
 
-from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer, SamBatched
+from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer, SamBatched, PackedImageEncoder
 
 
 def build_sam_vit_h(checkpoint=None):
@@ -44,6 +44,32 @@ def build_sam_vit_b(checkpoint=None):
     )
 
 
+def set_image_size(sam, image_size):
+    """
+    Runs the image encoder of a built SAM at another square input size. Absolute and
+    relative position embeddings are interpolated to the smaller token grid, and the
+    prompt encoder and mask post-processing follow the new embedding size.
+    """
+    patch_size = sam.image_encoder.patch_embed.proj.kernel_size[0]
+    assert image_size % patch_size == 0, f"image size must be a multiple of the patch size {patch_size}"
+    embedding_size = image_size // patch_size
+    sam.image_encoder.img_size = image_size
+    sam.prompt_encoder.input_image_size = (image_size, image_size)
+    sam.prompt_encoder.image_embedding_size = (embedding_size, embedding_size)
+    sam.prompt_encoder.mask_input_size = (4 * embedding_size, 4 * embedding_size)
+    return sam
+
+
+def pack_images(sam, grid):
+    """
+    Encodes grid x grid images in one forward of the image encoder. The images are
+    tiled into a mosaic of grid times the current image size, so set_image_size
+    should first reduce the image size to the mosaic size divided by grid.
+    """
+    sam.image_encoder = PackedImageEncoder(sam.image_encoder, grid)
+    return sam
+
+
 sam_model_registry = {
     "default": build_sam_vit_h,
     "vit_h": build_sam_vit_h,
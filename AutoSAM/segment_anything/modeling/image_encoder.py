@@ -106,7 +106,7 @@ class ImageEncoderViT(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
-            x = x + self.pos_embed
+            x = x + get_abs_pos(self.pos_embed, (x.shape[1], x.shape[2]))
 
         for blk in self.blocks:
             x = blk(x)
@@ -116,6 +116,47 @@ class ImageEncoderViT(nn.Module):
         return x
 
 
+class PackedImageEncoder(nn.Module):
+    """
+    Encodes a batch of small images grid x grid at a time: they are tiled into one
+    mosaic, the mosaic goes through a single encoder forward, and its embedding is
+    split back into one region per image. Images of a mosaic see each other through
+    the global and window attention, so their embeddings differ slightly from
+    encoding each image alone.
+    """
+
+    def __init__(self, encoder: nn.Module, grid: int) -> None:
+        """
+        Args:
+            encoder (nn.Module): Image encoder accepting the mosaic size, e.g. ImageEncoderViT.
+            grid (int): Number of images along each side of a mosaic.
+        """
+        super().__init__()
+        self.encoder = encoder
+        self.grid = grid
+
+    @property
+    def img_size(self) -> int:
+        # Input size of a single image, as used for padding and mask post-processing
+        return self.encoder.img_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, C, H, W = x.shape
+        g = self.grid
+        # Fill the last mosaic with blank images
+        pad = (-B) % (g * g)
+        if pad > 0:
+            x = torch.cat([x, x.new_zeros((pad, C, H, W))], dim=0)
+        M = x.shape[0] // (g * g)
+
+        # B C H W -> M C gH gW, image i of a mosaic in row i // g and column i % g
+        x = x.view(M, g, g, C, H, W).permute(0, 3, 1, 4, 2, 5).reshape(M, C, g * H, g * W)
+        x = self.encoder(x)
+        D, h, w = x.shape[1], x.shape[2] // g, x.shape[3] // g
+        x = x.view(M, D, g, h, g, w).permute(0, 2, 4, 1, 3, 5).reshape(M * g * g, D, h, w)
+        return x[:B]
+
+
 class Block(nn.Module):
     """Transformer blocks with support of window attention and residual propagation blocks"""
 
@@ -289,6 +330,29 @@ def window_unpartition(
     return x
 
 
+def get_abs_pos(abs_pos: torch.Tensor, hw: Tuple[int, int]) -> torch.Tensor:
+    """
+    Resize absolute positional embeddings to the token grid of the input, so the
+    encoder can run at a smaller image size than the one it was trained at.
+    Args:
+        abs_pos (Tensor): absolute positional embeddings with (1, H, W, C).
+        hw (Tuple): size of the input token grid (h, w).
+
+    Returns:
+        Absolute positional embeddings with (1, h, w, C).
+    """
+    if (abs_pos.shape[1], abs_pos.shape[2]) == tuple(hw):
+        return abs_pos
+    # Bicubic interpolation in float32, since half precision is not supported on every device
+    resized = F.interpolate(
+        abs_pos.permute(0, 3, 1, 2).float(),
+        size=hw,
+        mode="bicubic",
+        align_corners=False,
+    )
+    return resized.permute(0, 2, 3, 1).to(abs_pos.dtype)
+
+
 def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor:
     """
     Get relative positional embeddings according to the relative positions of
@@ -8,7 +8,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..modeling import Sam
 from .amg import calculate_stability_score
@@ -142,3 +142,59 @@ class SamOnnxModel(nn.Module):
             return upscaled_masks, scores, stability_scores, areas, masks
 
         return upscaled_masks, scores, masks
+
+
+class AutoSamOnnxModel(nn.Module):
+    """
+    This model should not be called directly, but is used in ONNX and TorchScript export.
+    It combines the prompt-free AutoSAM path: an embedding model predicts the dense
+    prompt embeddings from a downscaled copy of the image, and the mask decoder of Sam
+    predicts one mask from them, optionally after the image encoder. The low resolution
+    masks are min-max normalized per image, as in AutoSAM training and inference.
+    """
+
+    def __init__(
+        self,
+        embedding_model: nn.Module,
+        model: Sam,
+        embedding_input_size: int,
+        include_image_encoder: bool = True,
+    ) -> None:
+        super().__init__()
+        self.embedding_model = embedding_model
+        self.model = model
+        self.embedding_input_size = embedding_input_size
+        self.include_image_encoder = include_image_encoder
+        # Without prompts, the sparse embeddings and the dense positional encoding are constants
+        with torch.no_grad():
+            sparse_embeddings, _ = model.prompt_encoder(points=None, boxes=None, masks=None)
+            image_pe = model.prompt_encoder.get_dense_pe()
+        self.register_buffer("sparse_embeddings", sparse_embeddings, persistent=False)
+        self.register_buffer("image_pe", image_pe, persistent=False)
+
+    @staticmethod
+    def normalize_masks(masks: torch.Tensor) -> torch.Tensor:
+        flat = masks.flatten(1)
+        min_value = flat.min(dim=1)[0].view(-1, 1, 1, 1)
+        max_value = flat.max(dim=1)[0].view(-1, 1, 1, 1)
+        return (masks - min_value) / (max_value - min_value + 1e-6)
+
+    @torch.no_grad()
+    def forward(self, images: torch.Tensor, image_embeddings: Optional[torch.Tensor] = None):
+        images_small = F.interpolate(
+            images,
+            (self.embedding_input_size, self.embedding_input_size),
+            mode="bilinear",
+            align_corners=True,
+        )
+        dense_embeddings = self.embedding_model(images_small)
+        if self.include_image_encoder:
+            image_embeddings = self.model.image_encoder(self.model.preprocess(images))
+
+        masks, _ = self.model.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=self.image_pe,
+            sparse_prompt_embeddings=self.sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+        )
+        return self.normalize_masks(masks[:, 0:1, :, :])
@@ -0,0 +1,65 @@
+from functools import partial
+
+import pytest
+import torch
+from torch import nn
+
+from export_model import EXPORT_BATCH_SIZE, check_parity, example_inputs, export_onnx, export_torchscript
+from segment_anything.modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, SamBatched, TwoWayTransformer
+from segment_anything.utils.onnx import AutoSamOnnxModel
+
+IMAGE_SIZE = 64  # Input size of the tiny SAM image encoder, a 4x4 embedding grid
+EMBED_DIM = 32
+IDIM = 32  # Input size of the embedding model
+PARITY_BATCH_SIZE = EXPORT_BATCH_SIZE + 1
+TOLERANCE = 1e-4
+
+
+# A SAM with the layout of the real ones, small enough to export in a test, with random weights
+def tiny_sam():
+    embedding_size = IMAGE_SIZE // 16
+    return SamBatched(
+        image_encoder=ImageEncoderViT(
+            depth=2, embed_dim=EMBED_DIM, img_size=IMAGE_SIZE, mlp_ratio=2,
+            norm_layer=partial(nn.LayerNorm, eps=1e-6), num_heads=2, patch_size=16, qkv_bias=True,
+            use_rel_pos=True, global_attn_indexes=[1], window_size=2, out_chans=EMBED_DIM,
+        ),
+        prompt_encoder=PromptEncoder(
+            embed_dim=EMBED_DIM, image_embedding_size=(embedding_size, embedding_size),
+            input_image_size=(IMAGE_SIZE, IMAGE_SIZE), mask_in_chans=4,
+        ),
+        mask_decoder=MaskDecoder(
+            num_multimask_outputs=3,
+            transformer=TwoWayTransformer(depth=1, embedding_dim=EMBED_DIM, mlp_dim=64, num_heads=2),
+            transformer_dim=EMBED_DIM, iou_head_depth=2, iou_head_hidden_dim=EMBED_DIM,
+        ),
+        pixel_mean=[123.675, 116.28, 103.53],
+        pixel_std=[58.395, 57.12, 57.375],
+    ).eval()
+
+
+# Stands in for ModelEmb: dense prompt embeddings on the SAM embedding grid from the downscaled image
+def tiny_embedding_model():
+    return nn.Sequential(nn.Conv2d(3, EMBED_DIM, kernel_size=8, stride=8), nn.GELU()).eval()
+
+
+@pytest.mark.parametrize("include_image_encoder", [True, False])
+@pytest.mark.parametrize("export_format", ["torchscript", "onnx"])
+def test_exported_graph_matches_pytorch(tmp_path, export_format, include_image_encoder):
+    if export_format == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    sam, model = tiny_sam(), tiny_embedding_model()
+    onnx_model = AutoSamOnnxModel(model, sam, IDIM, include_image_encoder).eval()
+    inputs = example_inputs(sam, EXPORT_BATCH_SIZE, include_image_encoder)
+
+    output_path = str(tmp_path / ("autosam.onnx" if export_format == "onnx" else "autosam.pt"))
+    if export_format == "onnx":
+        export_onnx(onnx_model, inputs, output_path, opset=18)
+    else:
+        export_torchscript(onnx_model, inputs, output_path)
+
+    # The batch dimension of the graph is dynamic, so the parity check runs at another batch size
+    max_diff = check_parity(output_path, export_format, model, sam, IDIM, include_image_encoder, PARITY_BATCH_SIZE)
+    assert max_diff < TOLERANCE
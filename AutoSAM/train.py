@@ -4,16 +4,22 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 import os
+import contextlib
 import numpy as np
 from models.model_single import ModelEmb
 from dataset.glas import get_glas_dataset
 from dataset.MoNuBrain import get_monu_dataset
 from dataset.polyp import get_polyp_dataset, get_tests_polyp_dataset
-from dataset.tbm import get_tbm_dataset
-from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
+from dataset.tbm import get_tbm_dataset, AugmentationSlots
+from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator, set_image_size, pack_images
 from segment_anything.utils.transforms import ResizeLongestSide
+from embedding_cache import EmbeddingCache, is_deterministic, sam_tag
+from devices import get_device, setup_device
 import torch.nn.functional as F
- 
+
+PRECISIONS = ('fp32', 'mixed', 'bf16', 'fp16')
+SAM_IMAGE_SIZE = 1024  # Input size SAM was trained at
+
 
 def norm_batch(x):
     bs = x.shape[0]
@@ -45,6 +51,89 @@ def get_dice_ji(predict, target):
     return dice, ji
 
 
+def get_dice_ji_batch(predict, target):
+    # Same counts as get_dice_ji for every sample of a batch at once, in one reduction on the device
+    dims = tuple(range(1, predict.dim()))
+    tp = ((predict == 1) & (target == 1)).sum(dim=dims).double()
+    fp = ((predict == 1) & (target == 0)).sum(dim=dims).double()
+    fn = ((predict == 0) & (target == 1)).sum(dim=dims).double()
+    ji = torch.nan_to_num(tp / (tp + fp + fn))
+    dice = torch.nan_to_num(2 * tp / (2 * tp + fp + fn))
+    return dice, ji
+
+
+def postprocess_batch(masks, gts, sam, original_sz, img_sz, Idim):
+    # Resize the masks and GTs of a batch to Idim x Idim; samples sharing their input and original
+    # sizes are resized together, each group the same way a batch of one sample is
+    groups = {}
+    for i in range(len(masks)):
+        input_size = tuple([int(x) for x in img_sz[i].squeeze().tolist()])
+        original_size = tuple([int(x) for x in original_sz[i].squeeze().tolist()])
+        groups.setdefault((input_size, original_size), []).append(i)
+
+    out_masks = masks.new_empty((len(masks), 1, Idim, Idim))
+    out_gts = gts.new_empty((len(gts), 1, Idim, Idim))
+    for (input_size, original_size), idx in groups.items():
+        idx = torch.tensor(idx, device=masks.device)
+        group_masks = sam.postprocess_masks(masks[idx], input_size=input_size, original_size=original_size)
+        group_gts = sam.postprocess_masks(gts[idx].unsqueeze(dim=1), input_size=input_size, original_size=original_size)
+        out_masks[idx] = F.interpolate(group_masks, (Idim, Idim), mode='bilinear', align_corners=True)
+        out_gts[idx] = F.interpolate(group_gts, (Idim, Idim), mode='nearest')
+    return out_masks, out_gts
+
+
+def autocast_dtype(device, precision):
+    # 'mixed' takes bfloat16 on CPU and on GPUs that support it, float16 on older GPUs
+    if precision == 'fp32':
+        return None
+    if precision == 'mixed':
+        if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            return torch.float16
+        return torch.bfloat16
+    return torch.bfloat16 if precision == 'bf16' else torch.float16
+
+
+def precision_context(device, precision):
+    dtype = autocast_dtype(device, precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def load_sam(sam_args, device, image_size=SAM_IMAGE_SIZE, pack_grid=1):
+    # Below 1024 the encoder runs on a smaller token grid, so small crops are not upsampled to 1024 first.
+    # With packing, every image is resized to image_size / pack_grid and pack_grid x pack_grid images
+    # share one image_size x image_size encoder forward
+    sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
+    assert image_size % pack_grid == 0, 'the SAM image size must be a multiple of the pack grid'
+    if image_size // pack_grid != sam.image_encoder.img_size:
+        set_image_size(sam, image_size // pack_grid)
+    if pack_grid > 1:
+        pack_images(sam, pack_grid)
+    return sam.to(device=device)
+
+
+def load_model_emb(path, device, sam_image_size=None, pack_grid=1):
+    # The encoder input size sets the embedding size and the interpolation of the position embedding, and packed
+    # crops get the position embedding of their mosaic quadrant, so a model is only used with the SAM setup it was
+    # trained with. Models saved without the setup were unpacked, at a size that was not recorded
+    model = torch.load(path, map_location=device, weights_only=False)
+    setup = {'pack_grid': 1, **getattr(model, 'sam_setup', {})}
+    for name, value in (('sam_image_size', sam_image_size), ('pack_grid', pack_grid)):
+        if value is not None and name in setup:
+            assert setup[name] == value, \
+                '{} was trained with --{} {}, it cannot be used with --{} {}'.format(path, name, setup[name], name, value)
+    return model
+
+
+def default_sam_setup(args, model=None):
+    # SAM flags left unset take the setup the model was trained with, or the defaults for older models
+    setup = getattr(model, 'sam_setup', {})
+    for name, default in (('sam_image_size', SAM_IMAGE_SIZE), ('pack_grid', 1)):
+        if args.get(name) is None:
+            args[name] = setup.get(name, default)
+
+
 def open_folder(path):
     if not os.path.exists(path):
         os.mkdir(path)
@@ -53,13 +142,21 @@ def open_folder(path):
     return str(len(a))
 
 
-def gen_step(optimizer, gts, masks, criterion, accumulation_steps, step):
+def gen_step(optimizer, gts, masks, criterion, accumulation_steps, step, scaler=None):
     size = masks.shape[2:]
     gts_sized = F.interpolate(gts.unsqueeze(dim=1), size, mode='nearest')
     loss = criterion(masks, gts_sized) + Dice_loss(masks, gts_sized)
-    loss.backward()
+    # With float16 the loss is scaled, so small gradients do not underflow
+    if scaler is None:
+        loss.backward()
+    else:
+        scaler.scale(loss).backward()
     if (step + 1) % accumulation_steps == 0:  # Wait for several backward steps
-        optimizer.step()
+        if scaler is None:
+            optimizer.step()
+        else:
+            scaler.step(optimizer)
+            scaler.update()
         optimizer.zero_grad()
     return loss.item()
 
@@ -81,8 +178,9 @@ def get_input_dict(imgs, original_sz, img_sz):
 
 
 def postprocess_masks(masks_dict):
-    masks = torch.zeros((len(masks_dict), *masks_dict[0]['low_res_logits'].squeeze().shape)).unsqueeze(dim=1).cuda()
-    ious = torch.zeros(len(masks_dict)).cuda()
+    device = masks_dict[0]['low_res_logits'].device
+    masks = torch.zeros((len(masks_dict), *masks_dict[0]['low_res_logits'].squeeze().shape), device=device).unsqueeze(dim=1)
+    ious = torch.zeros(len(masks_dict), device=device)
     for i in range(len(masks_dict)):
         cur_mask = masks_dict[i]['low_res_logits'].squeeze()
         cur_mask = (cur_mask - cur_mask.min()) / (cur_mask.max() - cur_mask.min())
@@ -91,7 +189,29 @@ def postprocess_masks(masks_dict):
     return masks, ious
 
 
-def train_single_epoch(ds, model, sam, optimizer, transform, epoch):
+def encode_images(batched_input, sam):
+    with torch.no_grad():
+        input_images = torch.stack([sam.preprocess(x["image"]) for x in batched_input], dim=0)
+        return sam.image_encoder(input_images)
+
+
+def get_image_embeddings(imgs, batched_input, sam, embedding_cache):
+    # SAM is frozen, so cached embeddings replace the image encoder; only missing images are encoded
+    if embedding_cache is None:
+        return None
+    return embedding_cache.get_or_compute(
+        imgs, lambda missing: encode_images([batched_input[i] for i in missing], sam)).to(sam.device)
+
+
+def precompute_embeddings(ds, sam, embedding_cache, precision='fp32'):
+    for batch in tqdm(ds, desc='SAM embeddings'):
+        imgs, original_sz, img_sz = batch[0], batch[2], batch[3]
+        batched_input = get_input_dict(imgs.to(sam.device), original_sz, img_sz)
+        with precision_context(sam.device, precision):
+            get_image_embeddings(imgs, batched_input, sam, embedding_cache)
+
+
+def train_single_epoch(ds, model, sam, optimizer, transform, epoch, embedding_cache=None, scaler=None):
     loss_list = []
     pbar = tqdm(ds)
     criterion = nn.BCELoss()
@@ -101,10 +221,13 @@ def train_single_epoch(ds, model, sam, optimizer, transform, epoch):
         orig_imgs = imgs.to(sam.device)
         gts = gts.to(sam.device)
         orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
-        dense_embeddings = model(orig_imgs_small)
-        batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
-        masks = norm_batch(sam_call(batched_input, sam, dense_embeddings))
-        loss = gen_step(optimizer, gts, masks, criterion, accumulation_steps=4, step=ix)
+        # Only the forward runs in reduced precision, the losses are computed on the float32 masks
+        with precision_context(sam.device, args['precision']):
+            dense_embeddings = model(orig_imgs_small)
+            batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
+            image_embeddings = get_image_embeddings(imgs, batched_input, sam, embedding_cache)
+            masks = norm_batch(sam_call(batched_input, sam, dense_embeddings, image_embeddings))
+        loss = gen_step(optimizer, gts, masks, criterion, accumulation_steps=4, step=ix, scaler=scaler)
         loss_list.append(loss)
         pbar.set_description(
             '(train | {}) epoch {epoch} ::'
@@ -116,7 +239,7 @@ def train_single_epoch(ds, model, sam, optimizer, transform, epoch):
     return np.mean(loss_list)
 
 
-def inference_ds(ds, model, sam, transform, epoch, args):
+def inference_ds(ds, model, sam, transform, epoch, args, embedding_cache=None):
     pbar = tqdm(ds)
     model.eval()
     iou_list = []
@@ -126,21 +249,17 @@ def inference_ds(ds, model, sam, transform, epoch, args):
         orig_imgs = imgs.to(sam.device)
         gts = gts.to(sam.device)
         orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
-        dense_embeddings = model(orig_imgs_small)
-        batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
-        masks = norm_batch(sam_call(batched_input, sam, dense_embeddings))
-        input_size = tuple([int(x) for x in img_sz[0].squeeze().tolist()])
-        original_size = tuple([int(x) for x in original_sz[0].squeeze().tolist()])
-        masks = sam.postprocess_masks(masks, input_size=input_size, original_size=original_size)
-        gts = sam.postprocess_masks(gts.unsqueeze(dim=0), input_size=input_size, original_size=original_size)
-        masks = F.interpolate(masks, (Idim, Idim), mode='bilinear', align_corners=True)
-        gts = F.interpolate(gts, (Idim, Idim), mode='nearest')
+        with precision_context(sam.device, args.get('precision', 'fp32')):
+            dense_embeddings = model(orig_imgs_small)
+            batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
+            image_embeddings = get_image_embeddings(imgs, batched_input, sam, embedding_cache)
+            masks = norm_batch(sam_call(batched_input, sam, dense_embeddings, image_embeddings))
+        masks, gts = postprocess_batch(masks, gts, sam, original_sz, img_sz, Idim)
         masks[masks > 0.5] = 1
         masks[masks <= 0.5] = 0
-        dice, ji = get_dice_ji(masks.squeeze().detach().cpu().numpy(),
-                               gts.squeeze().detach().cpu().numpy())
-        iou_list.append(ji)
-        dice_list.append(dice)
+        dice, ji = get_dice_ji_batch(masks, gts)
+        iou_list.extend(ji.tolist())
+        dice_list.extend(dice.tolist())
         pbar.set_description(
             '(Inference | {task}) Epoch {epoch} :: Dice {dice:.4f} :: IoU {iou:.4f}'.format(
                 task=args['task'],
@@ -151,10 +270,10 @@ def inference_ds(ds, model, sam, transform, epoch, args):
     return np.mean(iou_list)
 
 
-def sam_call(batched_input, sam, dense_embeddings):
+def sam_call(batched_input, sam, dense_embeddings, image_embeddings=None):
     with torch.no_grad():
-        input_images = torch.stack([sam.preprocess(x["image"]) for x in batched_input], dim=0)
-        image_embeddings = sam.image_encoder(input_images)
+        if image_embeddings is None:
+            image_embeddings = encode_images(batched_input, sam)
         sparse_embeddings_none, dense_embeddings_none = sam.prompt_encoder(points=None, boxes=None, masks=None)
     low_res_masks, iou_predictions = sam.mask_decoder(
         image_embeddings=image_embeddings,
@@ -163,17 +282,59 @@ def sam_call(batched_input, sam, dense_embeddings):
         dense_prompt_embeddings=dense_embeddings,
         multimask_output=False,
     )
-    return low_res_masks
+    # Masks leave in float32 whatever the autocast precision, so normalization and losses stay exact
+    return low_res_masks.float()
+
+
+def evaluate_subset(ds, model, sam, Idim, precision):
+    # Mean Dice and IoU of a dataset, with SAM always running its image encoder
+    dice_list, iou_list = [], []
+    for imgs, gts, original_sz, img_sz, _ in ds:
+        orig_imgs = imgs.to(sam.device)
+        gts = gts.to(sam.device)
+        orig_imgs_small = F.interpolate(orig_imgs, (Idim, Idim), mode='bilinear', align_corners=True)
+        with precision_context(sam.device, precision):
+            batched_input = get_input_dict(orig_imgs, original_sz, img_sz)
+            masks = norm_batch(sam_call(batched_input, sam, model(orig_imgs_small)))
+        masks, gts = postprocess_batch(masks, gts, sam, original_sz, img_sz, Idim)
+        dice, ji = get_dice_ji_batch(masks > 0.5, gts)
+        dice_list.extend(dice.tolist())
+        iou_list.extend(ji.tolist())
+    return np.mean(dice_list), np.mean(iou_list)
+
+
+def check_precision(testset, model, sam, args):
+    """
+    Guard rail of reduced precision: compares Dice and IoU of a trained model on the first samples of the test set
+    with float32. Returns the precision to use, float32 when the reduced precision loses more than the tolerance.
+    """
+    precision, size = args['precision'], int(args['precision_check_size'])
+    if precision == 'fp32' or size <= 0:
+        return precision
+    subset = torch.utils.data.Subset(testset, range(min(size, len(testset))))
+    ds = torch.utils.data.DataLoader(subset, batch_size=int(args['eval_batch_size']), shuffle=False,
+                                     num_workers=int(args['nW_eval']), drop_last=False)
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        dice_fp32, iou_fp32 = evaluate_subset(ds, model, sam, int(args['Idim']), 'fp32')
+        dice, iou = evaluate_subset(ds, model, sam, int(args['Idim']), precision)
+    model.train(was_training)
+    print('Precision check on {} images: fp32 Dice {:.4f} IoU {:.4f}, {} Dice {:.4f} IoU {:.4f}'.format(
+        len(subset), dice_fp32, iou_fp32, precision, dice, iou))
+    if max(dice_fp32 - dice, iou_fp32 - iou) > float(args['precision_tolerance']):
+        print('{} loses more than {} Dice/IoU, falling back to fp32'.format(precision, args['precision_tolerance']))
+        return 'fp32'
+    return precision
 
 
 def main(args=None, sam_args=None):
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
-    model = ModelEmb(args=args).to(device)
-    sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
-    sam.to(device=device)
+    device = get_device(args['device'], sam_args['gpu_id'])
+    sam = load_sam(sam_args, device, int(args['sam_image_size']), int(args['pack_grid']))
+    args['embedding_size'] = sam.prompt_encoder.image_embedding_size[0]
+    model = setup_device(ModelEmb(args=args), device, int(args['num_threads']), args['memory_format'])
+    # Saved with the model, so inference and export can refuse a SAM setup the model was not trained with
+    model.sam_setup = {'sam_image_size': int(args['sam_image_size']), 'pack_grid': int(args['pack_grid'])}
     transform = ResizeLongestSide(sam.image_encoder.img_size)
     optimizer = optim.Adam(model.parameters(),
                            lr=float(args['learning_rate']),
@@ -189,15 +350,49 @@ def main(args=None, sam_args=None):
     ds = torch.utils.data.DataLoader(trainset, batch_size=int(args['Batch_size']), shuffle=True,
                                      num_workers=int(args['nW']), drop_last=True)
     
-    ds_val = torch.utils.data.DataLoader(testset, batch_size=1, shuffle=False,
+    ds_val = torch.utils.data.DataLoader(testset, batch_size=int(args['eval_batch_size']), shuffle=False,
                                          num_workers=int(args['nW_eval']), drop_last=False)
+    # The fp32 guard rail needs trained weights, so it runs in inference.py on the saved model, not here
+    scaler = None
+    if autocast_dtype(device, args['precision']) == torch.float16:
+        scaler = torch.amp.GradScaler(device.type)
+
+    # Embeddings are only cached for datasets whose transform gives the same input every epoch,
+    # or that draw their augmentations from a fixed set of slots per image
+    embedding_caches = {'train': None, 'test': None}
+    if args['embedding_cache'] and int(args['pack_grid']) > 1:
+        # A packed image embedding depends on the other images of its mosaic, so it cannot be cached per image
+        print('Packed encoding, the SAM embeddings are not cached')
+    elif args['embedding_cache']:
+        # Embeddings encoded in reduced precision or at another input size are kept apart
+        tag = sam_tag(sam_args)
+        if args['precision'] != 'fp32':
+            tag += ':{}'.format(autocast_dtype(device, args['precision']))
+        if sam.image_encoder.img_size != SAM_IMAGE_SIZE:
+            tag += ':{}px'.format(sam.image_encoder.img_size)
+        embedding_size = sam.prompt_encoder.image_embedding_size
+        cache = EmbeddingCache(args['embedding_cache'], tag, shape=(sam.prompt_encoder.embed_dim, *embedding_size))
+        embedding_caches['test'] = cache
+        loaders = {'test': ds_val}
+        if getattr(trainset, 'augmentation_slots', 0) > 0:
+            embedding_caches['train'] = cache
+            loaders['train'] = torch.utils.data.DataLoader(AugmentationSlots(trainset),
+                                                           batch_size=int(args['Batch_size']), shuffle=False,
+                                                           num_workers=int(args['nW']), drop_last=False)
+        elif is_deterministic(getattr(trainset, 'transform', None)):
+            embedding_caches['train'] = cache
+            loaders['train'] = ds
+        for name, loader in loaders.items():
+            precompute_embeddings(loader, sam, cache, args['precision'])
+        print('Cached SAM embeddings: {}'.format(len(cache)))
+
     best = 0
     path_best = 'results/gpu' + str(args['folder']) + '/best.csv'
     f_best = open(path_best, 'w')
     for epoch in range(int(args['epoches'])):
-        train_single_epoch(ds, model.train(), sam.eval(), optimizer, transform, epoch)
-        with torch.no_grad():
-            IoU_val = inference_ds(ds_val, model.eval(), sam, transform, epoch, args)
+        train_single_epoch(ds, model.train(), sam.eval(), optimizer, transform, epoch, embedding_caches['train'], scaler)
+        with torch.inference_mode():
+            IoU_val = inference_ds(ds_val, model.eval(), sam, transform, epoch, args, embedding_caches['test'])
             if IoU_val > best:
                 torch.save(model, args['path_best'])
                 best = IoU_val
@@ -214,6 +409,7 @@ if __name__ == '__main__':
     parser.add_argument('-epoches', '--epoches', default=256, help='number of epoches', required=False)
     parser.add_argument('-nW', '--nW', default=0, help='evaluation iteration', required=False)
     parser.add_argument('-nW_eval', '--nW_eval', default=0, help='evaluation iteration', required=False)
+    parser.add_argument('--eval_batch_size', type=int, default=4, help='Batch size of the validation after every epoch')
     parser.add_argument('-WD', '--WD', default=1e-4, help='evaluation iteration', required=False)
     parser.add_argument('-task', '--task', default='tbm', help='evaluation iteration', required=False)
     parser.add_argument('-depth_wise', '--depth_wise', default=False, help='image size', required=False)
@@ -226,6 +422,28 @@ if __name__ == '__main__':
     parser.add_argument('-test_data_root', '--test_data_root', help = 'test_data_root', required=True)
     parser.add_argument('--sam_checkpoint', type=str, help='Path to SAM checkpoint')
     parser.add_argument('--model_type', type=str, default="vit_h", help='Model type for SAM (e.g., vit_h)')
+    parser.add_argument('--device', type=str, default='auto',
+                        help='Device of the model and SAM, e.g. cpu, cuda or cuda:1 (auto: the GPU if there is one, else the CPU)')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of CPU threads of torch (0: torch default)')
+    parser.add_argument('--memory_format', type=str, default='auto', choices=['auto', 'channels_last', 'contiguous'],
+                        help='Memory format of the model weights (auto: channels_last on CPU, contiguous on GPU)')
+    parser.add_argument('--sam_image_size', type=int, default=SAM_IMAGE_SIZE,
+                        help='Input size of the SAM image encoder, a multiple of 16; e.g. 256 encodes 256x256 crops '
+                             'without upsampling them (the inference must use the same size)')
+    parser.add_argument('--pack_grid', type=int, default=1,
+                        help='Encode pack_grid x pack_grid images in one SAM forward, each resized to '
+                             'sam_image_size / pack_grid (e.g. 4: sixteen 256x256 crops per 1024x1024 forward)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Autocast precision of ModelEmb and SAM (mixed: bf16 on CPU and recent GPUs, else fp16)')
+    parser.add_argument('--embedding_cache', type=str, default=None,
+                        help='Directory of the frozen SAM image embedding cache, e.g. results/sam_embeddings; it takes '
+                             'about 2 MB of disk per image at the 1024 input size (default: no cache, the SAM image '
+                             'encoder runs on every batch)')
+    parser.add_argument('--augmentation_slots', type=int, default=0,
+                        help='Number of fixed augmentations per training image (0: a new random augmentation every time); '
+                             'with slots and --embedding_cache the embeddings of all slots are cached and each epoch '
+                             'samples one slot per image')
+    parser.add_argument('--augmentation_seed', type=int, default=0, help='Seed of the augmentation slots')
     args = vars(parser.parse_args())
     os.makedirs('results', exist_ok=True)
     folder = open_folder('results')
@@ -0,0 +1,34 @@
+import os
+import csv
+from collections import namedtuple
+
+# Constants
+MANIFEST_FILENAME = 'crops_manifest.csv'
+MANIFEST_FIELDS = ('name', 'image', 'y', 'x', 'width', 'height')
+
+# A crop that is never written to disk: the window (x, y, width, height) of a full image
+CropWindow = namedtuple('CropWindow', MANIFEST_FIELDS)
+
+def is_manifest(path):
+    "Check if a crop source path points to a crop manifest instead of a directory of crops."
+    return path.endswith('.csv') and os.path.isfile(path)
+
+def write_manifest(path, windows):
+    "Write crop windows to a manifest CSV, keeping the first window of every crop name."
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    seen = set()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(MANIFEST_FIELDS)
+        for window in windows:
+            if window.name in seen:
+                continue
+            seen.add(window.name)
+            writer.writerow([window.name, os.path.abspath(window.image), window.y, window.x, window.width, window.height])
+    return len(seen)
+
+def read_manifest(path):
+    "Read the crop windows of a manifest CSV."
+    with open(path, newline='') as f:
+        return [CropWindow(row['name'], row['image'], int(row['y']), int(row['x']), int(row['width']), int(row['height']))
+                for row in csv.DictReader(f)]
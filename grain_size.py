@@ -3,109 +3,481 @@ import numpy as np
 import pandas as pd
 from PIL import Image, ImageDraw
 import concurrent.futures
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, get_context
+from functools import lru_cache
 import argparse
+import hashlib
+from intercept_store import InterceptStore, RecordCache, concat_records, LABEL_COLUMNS
+from grain_statistics import RunningStatistics, bootstrap_mean_ci, BOOTSTRAP_RESAMPLES
+from crop_manifest import CropWindow, is_manifest, read_manifest
 
 
 # Define constants    
-MARGIN = 2  # Margin for excluding borders when drawing horizontal lines
+MARGIN = 2  # Margin for excluding borders when drawing test lines
+LINENUM = 20  # Number of test lines per orientation
+RENDER_MODES = ("none", "sample", "all")
+RENDER_SAMPLE_SIZE = 16  # Number of crops per model rendered in "sample" mode
+RESULTS_DIR = "results"  # Default directory of the outputs
+STORE_DIRNAME = "intercept_store"  # Columnar per-line intercept records under the output directory
+CACHE_FILENAME = "grain_cache.sqlite"  # Content-hash cache of measured crops under the output directory
+ALGORITHM_VERSION = 2  # Bump whenever a change to the measurement alters its results
+ORIENTATIONS = ("horizontal", "vertical", "diagonal_45", "diagonal_135", "circular")
+ORIENTATION_LABELS = {
+    "horizontal": "horiz",
+    "vertical": "vert",
+    "diagonal_45": "diag45",
+    "diagonal_135": "diag135",
+    "circular": "circ",
+}
 
 # Function to output messages
 def output(msg):
     print(msg)
 
-# Function to measure grain size
-def grainsize(croppedlist, linenum, output_dir=None):
-    grain_sizes = []
-    output("\n-- Measure Grain Size --")
-
+# Function to reduce a decoded crop to one uint8 plane, zero exactly on grain boundary (black) pixels
+def crop_plane(im_pixels):
+    if im_pixels.ndim == 3:
+        im_pixels = im_pixels[..., :3].max(axis=-1)
+    return im_pixels.astype(np.uint8, copy=False)
+
+# Function to get the file name of a crop, given as a path or as a manifest window
+def crop_name(crop):
+    return crop.name if isinstance(crop, CropWindow) else os.path.basename(crop)
+
+# Function to decode a full image once per process, manifest windows of the same image share it
+@lru_cache(maxsize=4)
+def full_image_plane(image_path):
+    return crop_plane(np.asarray(Image.open(image_path)))
+
+# Function to decode a crop into its plane, cutting manifest windows out of their full image
+def load_crop_plane(crop):
+    if not isinstance(crop, CropWindow):
+        return crop_plane(np.asarray(Image.open(crop)))
+
+    # Windows reaching past the image border are zero padded, like PIL's Image.crop
+    plane = full_image_plane(crop.image)
+    window = np.zeros((crop.height, crop.width), dtype=np.uint8)
+    top, left = max(crop.y, 0), max(crop.x, 0)
+    bottom, right = min(crop.y + crop.height, plane.shape[0]), min(crop.x + crop.width, plane.shape[1])
+    if bottom > top and right > left:
+        window[top - crop.y:bottom - crop.y, left - crop.x:right - crop.x] = plane[top:bottom, left:right]
+    return window
+
+# Function to open a crop as a PIL image to draw on
+def open_crop(crop):
+    if not isinstance(crop, CropWindow):
+        return Image.open(crop)
+    im = Image.open(crop.image).crop((crop.x, crop.y, crop.x + crop.width, crop.y + crop.height))
+    return im if im.mode in ("RGB", "RGBA") else im.convert("RGB")
+
+# Function to list the crops of a crop source: a directory of crop images or a crop manifest
+def list_crops(folder):
+    if is_manifest(folder):
+        return sorted(read_manifest(folder))
+    target_filenames = [f for f in os.listdir(folder) if f.endswith((".tif", ".jpg", ".png"))]
+    return [os.path.join(folder, f) for f in sorted(target_filenames)]
+
+# Function to mark grain boundary pixels of a crop plane or a stack of planes
+def boundary_mask(planes):
+    return planes == 0
+
+# Function to decode crops into one contiguous uint8 (N, H, W) stack per image size
+def load_crop_stacks(croppedlist):
+    planes = {}
     for f in croppedlist:
-        im = Image.open(f)
-        width, height = im.size
-        im_pixels = np.array(im)
-        draw = ImageDraw.Draw(im)
-
-        # Calculate interval excluding margins
-        interval = (height - 2 * MARGIN) // (linenum + 1)
-        sum_d = 0.0
-
-        # Draw horizontal lines and find grain boundaries
-        for l in range(linenum):
-            y = MARGIN + interval * (l + 1)
-            start, end = (0, y), (width, y)
-
-            # Create an image to find cross points
-            im2 = Image.new('RGB', (width, height))
-            draw2 = ImageDraw.Draw(im2)
-            draw2.line((start, end), fill=(255, 0, 0))
-            im2_pixels = np.array(im2)
-            im2_pixels = im2_pixels + im_pixels
-
-            # Identify pixels on grain boundary
-            pixelsonGB = [
-                (i, j) for j in range(height) for i in range(width)
-                if (im2_pixels[j, i] == [255, 0, 0]).all()
-            ]
-
-            # Calculate the distance between each pair of pixels on the grain boundary
-            distances_between_pixels = [
-                np.sqrt((coord2[0] - coord1[0]) ** 2 + (coord2[1] - coord1[1]) ** 2)
-                for coord1, coord2 in zip(pixelsonGB[:-1], pixelsonGB[1:])
-            ]
-
-            if distances_between_pixels:
-                d_grain = np.mean(distances_between_pixels)
-                sum_d += d_grain
-                output(f"D_horiz_{l} = {d_grain} [px]")
-                grain_sizes.append(d_grain)
-
-            # Draw line and grain boundaries
-            draw.line((start, end), fill=(255, 0, 0))
-            for coord in pixelsonGB:
-                draw.ellipse((coord[0]-1, coord[1]-1, coord[0]+1, coord[1]+1), outline=(0, 0, 255))
-
-        ave_d = sum_d / linenum
-        output(f"D_ave = {ave_d} [px]\n")
+        try:
+            plane = load_crop_plane(f)
+        except Exception as e:
+            output(f"Error loading {f}: {e}")
+            continue
+        planes.setdefault(plane.shape, []).append((f, plane))
+
+    stacks = []
+    for (height, width), loaded in planes.items():
+        stack = np.empty((len(loaded), height, width), dtype=np.uint8)
+        for n, (_, plane) in enumerate(loaded):
+            stack[n] = plane
+        stacks.append(([f for f, _ in loaded], stack))
+    return stacks
+
+# Function to compute evenly spaced test line offsets within an extent, excluding margins
+def line_offsets(extent, linenum, margin=MARGIN):
+    interval = (extent - 2 * margin) // (linenum + 1)
+    return margin + interval * np.arange(1, linenum + 1)
+
+# Function to make a traced path 4-connected, so a 1 px wide 8-connected boundary cannot slip
+# between two diagonally adjacent path pixels without being hit
+def four_connected(ys, xs, arc, length, closed=False, center=None):
+    ends = slice(None) if closed else slice(None, -1)
+    next_ys, next_xs = np.roll(ys, -1)[ends], np.roll(xs, -1)[ends]
+    next_arc = np.append(arc[1:], arc[:1] + length)[ends]
+    diagonal = np.flatnonzero((ys[ends] != next_ys) & (xs[ends] != next_xs))
+
+    # Bridge every diagonal step with one of its two 4-neighbours, the horizontal step first,
+    # or on a circle the neighbour closest to the circle
+    bridge_ys, bridge_xs = ys[diagonal], next_xs[diagonal]
+    if center is not None:
+        cy, cx, radius = center
+        other_ys, other_xs = next_ys[diagonal], xs[diagonal]
+        other = (np.abs(np.hypot(other_ys - cy, other_xs - cx) - radius)
+                 < np.abs(np.hypot(bridge_ys - cy, bridge_xs - cx) - radius))
+        bridge_ys, bridge_xs = np.where(other, other_ys, bridge_ys), np.where(other, other_xs, bridge_xs)
+    bridge_arc = (arc[diagonal] + next_arc[diagonal]) / 2
+
+    return (np.insert(ys, diagonal + 1, bridge_ys), np.insert(xs, diagonal + 1, bridge_xs),
+            np.insert(arc, diagonal + 1, bridge_arc), length)
+
+# Function to trace the pixels of a circle of the given radius around the image center
+def circle_pixels(height, width, radius):
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    theta = np.linspace(0, 2 * np.pi, int(np.ceil(8 * radius)) + 8, endpoint=False)
+    ys = np.rint(cy + radius * np.sin(theta)).astype(np.intp)
+    xs = np.rint(cx + radius * np.cos(theta)).astype(np.intp)
+
+    # Drop repeated pixels so every pixel of the closed path is visited once
+    keep = (ys != np.roll(ys, 1)) | (xs != np.roll(xs, 1))
+    return four_connected(ys[keep], xs[keep], radius * theta[keep], 2 * np.pi * radius,
+                          closed=True, center=(cy, cx, radius))
+
+# Function to trace a straight test line, with the distance of every pixel from its start
+def straight_line(ys, xs):
+    arc = np.hypot(ys - ys[0], xs - xs[0])
+    return ys, xs, arc, arc[-1]
+
+# Function to trace the test lines of one orientation as (ys, xs, arc length, line length)
+def trace_lines(height, width, linenum, margin, orientation):
+    lines = []
+    if orientation == "horizontal":
+        for y in line_offsets(height, linenum, margin):
+            lines.append(straight_line(np.full(width, y), np.arange(width)))
+    elif orientation == "vertical":
+        for x in line_offsets(width, linenum, margin):
+            lines.append(straight_line(np.arange(height), np.full(height, x)))
+    elif orientation == "diagonal_45":
+        # Rising lines x + y = s, traced from left to right
+        for s in line_offsets(height + width - 1, linenum, margin):
+            xs = np.arange(max(0, s - (height - 1)), min(width - 1, s) + 1)
+            lines.append(four_connected(*straight_line(s - xs, xs)))
+    elif orientation == "diagonal_135":
+        # Falling lines x - y = d, traced from left to right
+        for d in line_offsets(height + width - 1, linenum, margin) - (height - 1):
+            xs = np.arange(max(0, d), min(width - 1, d + height - 1) + 1)
+            lines.append(four_connected(*straight_line(xs - d, xs)))
+    elif orientation == "circular":
+        # Concentric Hilligoss circles around the image center
+        interval = (min(height, width) // 2 - margin) // (linenum + 1)
+        for radius in interval * np.arange(1, linenum + 1):
+            lines.append(circle_pixels(height, width, radius))
+    else:
+        raise ValueError(f"Unknown orientation: {orientation}")
+    return lines
+
+# Class holding the flat pixel indices of every test line for one image geometry
+class ProbeGeometry:
+    def __init__(self, height, width, orientations, lines):
+        self.height = height
+        self.width = width
+        self.orientations = tuple(orientations)  # Orientation of every line
+        self.ys = np.concatenate([line[0] for line in lines]).astype(np.intp)
+        self.xs = np.concatenate([line[1] for line in lines]).astype(np.intp)
+        self.flat_index = self.ys * width + self.xs
+        self.line_id = np.concatenate([np.full(len(line[0]), l) for l, line in enumerate(lines)])
+        self.arc = np.concatenate([line[2] for line in lines])
+        self.length = np.array([line[3] for line in lines], dtype=np.float64)
+        self.closed = np.array([o == "circular" for o in self.orientations])
+
+        # Cached geometries are shared between crops, keep them read only
+        for array in (self.ys, self.xs, self.flat_index, self.line_id, self.arc, self.length, self.closed):
+            array.flags.writeable = False
+
+    @property
+    def num_lines(self):
+        return len(self.length)
+
+    # Gather all test line pixels of an image (or a stack of images) with one fancy index
+    def gather(self, image):
+        return image.reshape(image.shape[:-2] + (-1,))[..., self.flat_index]
+
+    # Concatenate several geometries of the same image size into one probe set
+    @classmethod
+    def concatenate(cls, geometries):
+        lines, orientations = [], []
+        for geometry in geometries:
+            for l in range(geometry.num_lines):
+                on_line = geometry.line_id == l
+                lines.append((geometry.ys[on_line], geometry.xs[on_line],
+                              geometry.arc[on_line], geometry.length[l]))
+                orientations.append(geometry.orientations[l])
+        return cls(geometries[0].height, geometries[0].width, orientations, lines)
+
+# Function to get the cached probe geometry of one orientation
+@lru_cache(maxsize=64)
+def probe_geometry(height, width, linenum, margin, orientation):
+    lines = trace_lines(height, width, linenum, margin, orientation)
+    return ProbeGeometry(height, width, [orientation] * len(lines), lines)
+
+# Function to get the cached probe geometry of several orientations measured together
+@lru_cache(maxsize=16)
+def probe_set(height, width, linenum, margin, orientations):
+    return ProbeGeometry.concatenate(
+        [probe_geometry(height, width, linenum, margin, orientation) for orientation in orientations])
+
+# Function to measure Heyn intercepts along all test lines of a stack of crops in one pass
+def line_intercepts(masks, geometry):
+    num_crops, num_lines = masks.shape[0], geometry.num_lines
+
+    # Gather every test line pixel of every crop at once and keep the ones on a grain boundary
+    hit_crop, hit_pixel = np.nonzero(geometry.gather(masks))
+    hit_line = geometry.line_id[hit_pixel]
+    key = hit_crop * num_lines + hit_line
+    pos = geometry.arc[hit_pixel]
+    counts = np.bincount(key, minlength=num_crops * num_lines)
+
+    # Distances between consecutive boundary pixels, summed per crop and test line
+    same_line = key[1:] == key[:-1]
+    gaps = np.diff(pos)[same_line]
+    sums = np.bincount(key[1:][same_line], weights=gaps, minlength=num_crops * num_lines)
+
+    # Mean intercept per line, NaN where the line does not bound a grain. Open lines
+    # need two boundary pixels; a closed circle is split into as many arcs as it has hits.
+    closed, length = np.tile(geometry.closed, num_crops), np.tile(geometry.length, num_crops)
+    d_lines = np.full(num_crops * num_lines, np.nan)
+    valid = ~closed & (counts > 1)
+    d_lines[valid] = sums[valid] / (counts[valid] - 1)
+    valid_closed = closed & (counts > 0)
+    d_lines[valid_closed] = length[valid_closed] / counts[valid_closed]
+    return (d_lines.reshape(num_crops, num_lines), hit_crop, hit_line,
+            geometry.ys[hit_pixel], geometry.xs[hit_pixel], pos)
+
+# Function to draw the test lines and the grain boundary pixels they hit onto a crop
+def render_crop(f, geometry, hits, output_dir):
+    hit_line, hit_ys, hit_xs = hits[:3]
+    im = open_crop(f)
+    draw = ImageDraw.Draw(im)
+    for l in range(geometry.num_lines):
+        on_line = geometry.line_id == l
+        draw.point(list(zip(geometry.xs[on_line].tolist(), geometry.ys[on_line].tolist())),
+                   fill=(255, 0, 0))
+        hit_on_line = hit_line == l
+        for x, y in zip(hit_xs[hit_on_line], hit_ys[hit_on_line]):
+            draw.ellipse((x - 1, y - 1, x + 1, y + 1), outline=(0, 0, 255))
+
+    output_image_path = os.path.join(output_dir, f"heyn_{crop_name(f)}")
+    im.save(output_image_path)
+
+# Function to measure a list of crops, yielding the measurements and boundary hits of every crop
+def measure_crops(croppedlist, linenum, orientations=("horizontal",), margin=MARGIN):
+    orientations = tuple(orientations)
+
+    for paths, stack in load_crop_stacks(croppedlist):
+        # Test lines are precomputed once per image geometry and reused across crops
+        height, width = stack.shape[1:]
+        try:
+            geometry = probe_set(height, width, linenum, margin, orientations)
+
+            # Find grain boundaries on all test lines of all crops at once
+            d_lines, hit_crop, hit_line, hit_ys, hit_xs, hit_arc = line_intercepts(boundary_mask(stack), geometry)
+        except Exception as e:
+            # Crops of one size share their test lines, so a size that cannot be measured fails each of them
+            for f in paths:
+                output(f"Error measuring {crop_name(f)}: {e}")
+            continue
+        bounds = np.searchsorted(hit_crop, np.arange(len(paths) + 1))
+
+        for n, f in enumerate(paths):
+            crop_sizes = []
+            sum_d = 0.0
+            for k, orientation in enumerate(orientations):
+                label = ORIENTATION_LABELS[orientation]
+                for l in range(linenum):
+                    d_grain = d_lines[n, k * linenum + l]
+                    if not np.isnan(d_grain):
+                        sum_d += d_grain
+                        output(f"D_{label}_{l} = {d_grain} [px]")
+                        crop_sizes.append((orientation, d_grain))
+
+            ave_d = sum_d / (linenum * len(orientations))
+            output(f"D_ave = {ave_d} [px]\n")
+
+            on_crop = slice(bounds[n], bounds[n + 1])
+            hits = (hit_line[on_crop], hit_ys[on_crop], hit_xs[on_crop], hit_arc[on_crop])
+            yield f, geometry, d_lines[n], crop_sizes, hits
+
+# Function to measure grain size, returning the (orientation, size) measurements of every crop
+def grainsize(croppedlist, linenum, output_dir=None, orientations=("horizontal",), margin=MARGIN):
+    grain_sizes = {}
+    output("\n-- Measure Grain Size --")
 
+    for f, geometry, _, crop_sizes, hits in measure_crops(croppedlist, linenum, orientations, margin):
+        grain_sizes[f] = crop_sizes
         if output_dir:
-            output_image_path = os.path.join(output_dir, f"heyn_{os.path.basename(f)}")
-            im.save(output_image_path)
+            render_crop(f, geometry, hits, output_dir)
     
     return grain_sizes
 
-# Function to calculate statistics for grain sizes
-def calculate_statistics(grain_sizes):
-    if not grain_sizes:
-        return {}
-
-    mean = np.mean(grain_sizes)
-    variance = np.var(grain_sizes)
+# Function to build the label columns of a crop's per-line store records
+def crop_labels(model, filename, num_lines):
+    crop_y, crop_x = extract_crop_coordinates(filename)
+    return {
+        "model": np.full(num_lines, model),
+        "crop": np.full(num_lines, filename),
+        "degem": np.full(num_lines, extract_degem(filename)),
+        "crop_y": np.full(num_lines, crop_y, dtype=np.int32),
+        "crop_x": np.full(num_lines, crop_x, dtype=np.int32),
+    }
 
+# Function to build the per-line store records of one measured crop
+def crop_records(model, filename, geometry, linenum, d_row, hits):
+    num_lines = geometry.num_lines
+    hit_line, hit_ys, hit_xs, hit_arc = hits
     return {
-        'Mean': mean,
-        'Variance': variance
+        **crop_labels(model, filename, num_lines),
+        "height": np.full(num_lines, geometry.height, dtype=np.int32),
+        "width": np.full(num_lines, geometry.width, dtype=np.int32),
+        "orientation": np.array(geometry.orientations),
+        "line": (np.arange(num_lines) % linenum).astype(np.int16),
+        "grain_size": np.asarray(d_row, dtype=np.float64),
+        "hit_count": np.bincount(hit_line, minlength=num_lines).astype(np.int32),
+        "hit_ys": hit_ys.astype(np.int32),
+        "hit_xs": hit_xs.astype(np.int32),
+        "hit_arc": hit_arc.astype(np.float64),
     }
 
-# Function to process images and measure grain sizes
-def process_image(folder, model, target_filename, model_output_dir):
-    image_path = os.path.join(folder, target_filename)
-    if not os.path.exists(image_path):
-        output(f"File not found: {image_path}")
-        return None
+# Function to draw the overlay of a crop from its per-line records
+def render_record(image_path, record, linenum, margin, output_dir):
+    orientations = tuple(dict.fromkeys(record["orientation"].tolist()))
+    geometry = probe_set(int(record["height"][0]), int(record["width"][0]), linenum, margin, orientations)
+
+    # Map the stored (orientation, line) of every hit back to the probe set line index
+    line_ids = [orientations.index(o) * linenum + int(l) for o, l in zip(record["orientation"], record["line"])]
+    hits = (np.repeat(line_ids, record["hit_count"]), record["hit_ys"], record["hit_xs"])
+    render_crop(image_path, geometry, hits, output_dir)
+
+# Function to render overlays on demand from the intercept store, without re-measuring the crops
+def render_stored(store_root, model, filenames=None, output_dir=None):
+    store = InterceptStore(store_root)
+    # Overlays go next to the store by default, where analyze_images renders them
+    output_dir = output_dir or os.path.join(os.path.dirname(os.path.abspath(store_root)), model.replace(" ", "_"))
+    os.makedirs(output_dir, exist_ok=True)
+    wanted = set(filenames) if filenames else None
+
+    for part in store.parts():
+        meta = store.read_meta(part)
+        if model not in meta["folders"]:
+            continue
+        folder, linenum, margin = meta["folders"][model], meta["linenum"], meta["margin"]
+        windows = {window.name: window for window in read_manifest(folder)} if is_manifest(folder) else None
+        data = store.read_part(part)
+        rows = np.flatnonzero(data["model"] == model)
+        crops = data["crop"][rows]
+
+        for crop in dict.fromkeys(crops.tolist()):
+            if wanted is not None and crop not in wanted:
+                continue
+            crop_rows = rows[crops == crop]
+            counts = data["hit_count"][crop_rows]
+            on_crop = np.concatenate([np.arange(o, o + c) for o, c in zip(data["hit_offset"][crop_rows], counts)])
+            record = {name: data[name][crop_rows] for name in ("height", "width", "orientation", "line")}
+            record.update(hit_count=counts, hit_ys=data["hit_ys"][on_crop], hit_xs=data["hit_xs"][on_crop])
+            render_record(windows[crop] if windows else os.path.join(folder, crop), record, linenum, margin, output_dir)
+            output(f"Rendered heyn_{crop}")
+
+# Function to hash the content of an image file, once per file for all windows cut from it
+@lru_cache(maxsize=64)
+def file_hash(image_path):
+    with open(image_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Function to build the cache key of a crop from its content and the measurement parameters
+def cache_key(crop, linenum, margin, orientations):
+    if isinstance(crop, CropWindow):
+        content_hash = f"{file_hash(crop.image)}:{crop.y}:{crop.x}:{crop.height}:{crop.width}"
+    else:
+        content_hash = file_hash(crop)
+    params = f"{linenum}:{margin}:{','.join(orientations)}:{ALGORITHM_VERSION}"
+    return hashlib.sha256(f"{content_hash}:{params}".encode()).hexdigest()
+
+# Function to choose which crops of a folder get an overlay rendered
+def select_render_filenames(target_filenames, render, sample_size=RENDER_SAMPLE_SIZE):
+    if render == "all":
+        return set(target_filenames)
+    if render == "sample":
+        step = max(1, len(target_filenames) // sample_size)
+        return set(sorted(target_filenames)[::step][:sample_size])
+    return set()
 
-    output(f"Processing image: {target_filename}")
+# Function to calculate statistics for grain sizes
+def calculate_statistics(grain_sizes):
+    statistics = RunningStatistics()
+    statistics.update(grain_sizes)
+    return statistics.summary()
+
+# Function to add the measured grain sizes of one crop record to the per (Model, Degem, Orientation) statistics
+def update_statistics(statistics, record):
+    measured = np.isfinite(record["grain_size"])
+    model, degem = str(record["model"][0]), str(record["degem"][0])
+    for orientation in dict.fromkeys(record["orientation"].tolist()):
+        values = record["grain_size"][measured & (record["orientation"] == orientation)]
+        if len(values):
+            statistics.setdefault((model, degem, orientation), RunningStatistics()).update(values)
+
+# Function to tabulate the merged statistics of every group together with bootstrap CIs of its mean
+def summarize_statistics(statistics, df, num_resamples=BOOTSTRAP_RESAMPLES, confidence=0.95):
+    # The bootstrap resamples the individual grain sizes, so unlike the streamed statistics it needs
+    # the whole Grain Size column in memory. Group ids and keys are taken in the same group order.
+    groups = df.groupby(['Model', 'Degem', 'Orientation'], sort=False)
+    low, high = bootstrap_mean_ci(df['Grain Size'].to_numpy(), groups.ngroup().to_numpy(),
+                                  num_resamples, confidence)
+    ci = {key: (lo, hi) for key, lo, hi in zip(groups.size().index, low, high)} if len(df) else {}
+
+    rows = []
+    for (model, degem, orientation), group_statistics in sorted(statistics.items()):
+        lo, hi = ci.get((model, degem, orientation), (np.nan, np.nan))
+        rows.append({'Model': model, 'Degem': degem, 'Orientation': orientation,
+                     **group_statistics.summary(), 'Mean CI Low': lo, 'Mean CI High': hi})
+        output(f"{model} {degem} {orientation}: mean {group_statistics.mean:.3f} [px], "
+               f"{confidence:.0%} CI [{lo:.3f}, {hi:.3f}]")
+    return pd.DataFrame(rows)
+
+# Function to process a chunk of crops of one model (crop image paths or manifest windows) and measure their grain sizes
+def process_images(crops, model, model_output_dir, orientations=("horizontal",), render_filenames=()):
+    existing = []
+    for crop in crops:
+        image_path = crop.image if isinstance(crop, CropWindow) else crop
+        if not os.path.exists(image_path):
+            output(f"File not found: {image_path}")
+            continue
+        existing.append(crop)
+
+    output(f"Processing {len(existing)} crops of {model}")
+    records, statistics = [], {}
+    for crop, geometry, d_row, _, hits in measure_crops(existing, LINENUM, orientations):
+        # A crop that fails only loses its own record, not the rest of the chunk
+        filename = crop_name(crop)
+        try:
+            record = crop_records(model, filename, geometry, LINENUM, d_row, hits)
+        except Exception as e:
+            output(f"Error processing {filename} of {model}: {e}")
+            continue
+        records.append(record)
+        update_statistics(statistics, record)
+
+        # Overlays are only drawn for the selected crops, the rest can be rendered later
+        if filename in render_filenames:
+            try:
+                render_crop(crop, geometry, hits, model_output_dir)
+            except Exception as e:
+                output(f"Error rendering {filename} of {model}: {e}")
+
+    return records, statistics
+
+# Function to extract the (y, x) position of a crop in its full image from the filename
+def extract_crop_coordinates(filename):
+    parts = os.path.splitext(filename)[0].split('-')
     try:
-        degem = extract_degem(target_filename)
-        grain_sizes = grainsize([image_path], 20, model_output_dir)
-
-        return {
-            'Model': model,
-            'Degem': degem,
-            'Grain Sizes': grain_sizes
-        }
-    except Exception as e:
-        output(f"Error processing {image_path}: {e}")
-        return None
+        return int(parts[-2]), int(parts[-1])
+    except (IndexError, ValueError):
+        return -1, -1
 
 # Function to extract degem (identifier) from the filename
 def extract_degem(filename):
@@ -117,50 +489,117 @@ def extract_degem(filename):
         return "unknown"
 
 # Function to analyze images from multiple directories
-def analyze_images(image_dirs):
-    model_degem_grain_sizes = []
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-        futures = []
+def analyze_images(image_dirs, orientations=("horizontal",), workers=None, chunk_size=64, render="all",
+                   render_sample_size=RENDER_SAMPLE_SIZE, cache_path=None, bootstrap_resamples=BOOTSTRAP_RESAMPLES,
+                   confidence=0.95, output_dir=RESULTS_DIR):
+    # Per-line records of every batch are appended to the store as soon as they arrive
+    store = InterceptStore(os.path.join(output_dir, STORE_DIRNAME))
+    store.clear()
+    cache = RecordCache(cache_path) if cache_path else None
+    orientations = tuple(orientations)
+    statistics = {}
+
+    # Workers are spawned, not forked, as the pipeline calls this from one of its stage threads
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or cpu_count(),
+                                                mp_context=get_context("spawn")) as executor:
+        futures = {}
         for folder, model in image_dirs:
             if not os.path.exists(folder):
                 output(f"Folder not found: {folder}")
                 continue
 
-            target_filenames = [f for f in os.listdir(folder) if f.endswith((".tif", ".jpg", ".png"))]
+            # A manifest lists virtual crops, windows cut from the full images while measuring
+            crops = list_crops(folder)
 
-            if not target_filenames:
-                output(f"No TIFF, JPG, or PNG files found in {folder}")
+            if not crops:
+                output(f"No TIFF, JPG, or PNG crops found in {folder}")
                 continue
 
-            model_output_dir = os.path.join("results", model.replace(" ", "_"))
+            model_output_dir = os.path.join(output_dir, model.replace(" ", "_"))
             os.makedirs(model_output_dir, exist_ok=True)
 
-            for target_filename in target_filenames:
-                futures.append(executor.submit(process_image, folder, model, target_filename, model_output_dir))
+            target_filenames = [crop_name(crop) for crop in crops]
+            render_filenames = select_render_filenames(target_filenames, render, render_sample_size)
+            meta = {"linenum": LINENUM, "margin": MARGIN, "folders": {model: os.path.abspath(folder)}}
+
+            # Crops whose content was already measured with the same parameters are taken from the cache
+            keys, pending = {}, crops
+            if cache:
+                cached, pending = [], []
+                for crop, filename in zip(crops, target_filenames):
+                    keys[filename] = cache_key(crop, LINENUM, MARGIN, orientations)
+                    record = cache.get(keys[filename])
+                    if record is None:
+                        pending.append(crop)
+                        continue
+                    record = {**crop_labels(model, filename, len(record["line"])), **record}
+                    cached.append(record)
+                    update_statistics(statistics, record)
+                    if filename in render_filenames:
+                        render_record(crop, record, LINENUM, MARGIN, model_output_dir)
+
+                output(f"{model}: {len(cached)} crops cached, {len(pending)} to measure")
+                if cached:
+                    store.append(concat_records(cached), meta)
+
+            # Each worker decodes and measures a whole chunk of crops as one stack
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                future = executor.submit(process_images, chunk, model, model_output_dir, orientations,
+                                         render_filenames.intersection(map(crop_name, chunk)))
+                futures[future] = (meta, keys)
 
         for future in concurrent.futures.as_completed(futures):
-            image_data = future.result()
-            if image_data:
-                model, degem, grain_sizes = image_data['Model'], image_data['Degem'], image_data['Grain Sizes']
-                model_degem_grain_sizes.extend([[model, degem, size] for size in grain_sizes])
-
-    # Convert to DataFrame and save to CSV
-    df = pd.DataFrame(model_degem_grain_sizes, columns=['Model', 'Degem', 'Grain Size'])
-    df.sort_values(by=['Model', 'Degem', 'Grain Size'], inplace=True)
-
-    csv_path = os.path.join("results", "all_models_grain_sizes.csv")
-    df.to_csv(csv_path, index=False)
+            result = future.result()
+            if result and result[0]:
+                records, chunk_statistics = result
+                for key, group_statistics in chunk_statistics.items():
+                    statistics.setdefault(key, RunningStatistics()).merge(group_statistics)
+                meta, keys = futures[future]
+                store.append(concat_records(records), meta)
+                if cache:
+                    cache.put_many((keys[str(record["crop"][0])],
+                                    {name: values for name, values in record.items() if name not in LABEL_COLUMNS})
+                                   for record in records)
+
+    if cache:
+        cache.close()
+
+    # The CSV is a view over the store
+    csv_path = os.path.join(output_dir, "all_models_grain_sizes.csv")
+    df = store.export_csv(csv_path)
     output(f"Saved all models' data to {csv_path}")
 
+    # Streamed statistics merged from the workers, with bootstrap CIs per (Model, Degem, Orientation)
+    statistics_path = os.path.join(output_dir, "grain_size_statistics.csv")
+    summarize_statistics(statistics, df, bootstrap_resamples, confidence).to_csv(statistics_path, index=False)
+    output(f"Saved grain size statistics to {statistics_path}")
+
     return df
 
 # Main function to set directories and start processing
 def main():
     parser = argparse.ArgumentParser(description="Analyze images for grain size calculation.")
-    parser.add_argument("--gt_path", required=True, help="Path to 256x256 crops of Ground Truth images")
-    parser.add_argument("--mlography_path", required=True, help="Path to 256x256 crops of MLography predictions not overlapping with Ground Truth")
-    parser.add_argument("--mlography_plus_plus_path", required=True, help="Path to 256x256 crops of MLOgraphy++ predictions not overlapping with Ground Truth")
+    parser.add_argument("--gt_path", required=True, help="Path to 256x256 crops of Ground Truth images, or to their crop manifest")
+    parser.add_argument("--mlography_path", required=True, help="Path to 256x256 crops of MLography predictions not overlapping with Ground Truth, or to their crop manifest")
+    parser.add_argument("--mlography_plus_plus_path", required=True, help="Path to 256x256 crops of MLOgraphy++ predictions not overlapping with Ground Truth, or to their crop manifest")
+    parser.add_argument("--orientations", nargs="+", choices=ORIENTATIONS, default=["horizontal"],
+                        help="Test line orientations to measure along (circular uses concentric Hilligoss circles)")
+    parser.add_argument("--workers", type=int, default=cpu_count(), help="Number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Number of crops measured together by one worker task")
+    parser.add_argument("--render", choices=RENDER_MODES, default="all",
+                        help="Which crops get a heyn_ overlay rendered: none, an evenly spaced sample per model, or all")
+    parser.add_argument("--render_sample_size", type=int, default=RENDER_SAMPLE_SIZE,
+                        help="Number of crops per model rendered with --render sample")
+    parser.add_argument("--output_dir", default=RESULTS_DIR,
+                        help="Directory of the intercept store, the CSVs, the overlays and the cache")
+    parser.add_argument("--cache_path", default=None,
+                        help="Path to the content-hash cache of measured crops, so unchanged crops are not measured again "
+                             f"(default: <output_dir>/{CACHE_FILENAME})")
+    parser.add_argument("--no_cache", action="store_true", help="Measure every crop without reading or updating the cache")
+    parser.add_argument("--bootstrap_resamples", type=int, default=BOOTSTRAP_RESAMPLES,
+                        help="Number of bootstrap resamples for the confidence intervals of the mean grain sizes")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
 
     args = parser.parse_args()
 
@@ -171,7 +610,10 @@ def main():
     ]
 
     output("Starting analysis...")
-    model_degem_grain_sizes = analyze_images(sub_model_folders)
+    model_degem_grain_sizes = analyze_images(sub_model_folders, args.orientations, args.workers, args.chunk_size,
+                                             args.render, args.render_sample_size,
+                                             None if args.no_cache else args.cache_path or os.path.join(args.output_dir, CACHE_FILENAME),
+                                             args.bootstrap_resamples, args.confidence, args.output_dir)
     output("Analysis complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+# Define constants
+RELATIVE_ACCURACY = 0.01  # Relative error of the quantiles estimated by QuantileSketch
+BOOTSTRAP_RESAMPLES = 1000
+BOOTSTRAP_CHUNK = 100  # Resamples drawn at once, bounds the memory of the bootstrap
+
+# Mergeable quantile sketch with log-spaced buckets, every quantile is within RELATIVE_ACCURACY of the true value
+class QuantileSketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0  # Values <= 0 cannot be log bucketed
+        self.count = 0
+
+    # Function to add a batch of values to the sketch
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    # Function to merge another sketch with the same relative accuracy into this one
+    def merge(self, other):
+        if not np.isclose(self.gamma, other.gamma):
+            raise ValueError("Cannot merge quantile sketches with different relative accuracy")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    # Function to estimate the q-quantile (0 <= q <= 1) of the values seen so far
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+# Streaming moments (Welford / Chan et al.) and quantiles of grain sizes, mergeable across processes
+class RunningStatistics:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    # Function to combine the moments of another set of values into this one
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    # Function to add a batch of values, e.g. the grain sizes of one crop
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        batch_mean = values.mean()
+        self._combine(len(values), batch_mean, np.sum((values - batch_mean) ** 2))
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sketch.update(values)
+
+    # Function to merge the statistics accumulated by another process into this one
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    # Function to estimate the q-quantile, clamped to the observed range the sketch buckets can overshoot
+    def quantile(self, q):
+        return float(np.clip(self.sketch.quantile(q), self.min, self.max))
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    def summary(self):
+        if self.count == 0:
+            return {}
+        return {
+            'Count': self.count,
+            'Mean': self.mean,
+            'Variance': self.variance,
+            'Min': self.min,
+            'Q1': self.quantile(0.25),
+            'Median': self.quantile(0.5),
+            'Q3': self.quantile(0.75),
+            'Max': self.max,
+        }
+
+# Function to compute percentile bootstrap confidence intervals of the mean of every group at once.
+# group_ids assigns every value to a group 0..G-1; returns (low, high) arrays of length G.
+def bootstrap_mean_ci(values, group_ids, num_resamples=BOOTSTRAP_RESAMPLES, confidence=0.95, seed=0):
+    values = np.asarray(values, dtype=np.float64)
+    group_ids = np.asarray(group_ids)
+    order = np.argsort(group_ids, kind="stable")
+    values, group_ids = values[order], group_ids[order]
+    num_groups = int(group_ids.max()) + 1 if len(group_ids) else 0
+    sizes = np.bincount(group_ids, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    if num_groups == 0:
+        return np.array([]), np.array([])
+
+    # Every resample redraws each group with replacement from its own values, all groups in one draw
+    rng = np.random.default_rng(seed)
+    sizes_of_value, starts_of_value = sizes[group_ids], starts[group_ids]
+    nonempty = sizes > 0
+    means = []
+    for done in range(0, num_resamples, BOOTSTRAP_CHUNK):
+        chunk = min(BOOTSTRAP_CHUNK, num_resamples - done)
+        draws = starts_of_value + (rng.random((chunk, len(values))) * sizes_of_value).astype(np.int64)
+        sums = np.add.reduceat(values[draws], starts[nonempty], axis=1)
+        means.append(sums / sizes[nonempty])
+    means = np.concatenate(means)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.full(num_groups, np.nan), np.full(num_groups, np.nan)
+    low[nonempty], high[nonempty] = np.quantile(means, [alpha, 1 - alpha], axis=0)
+    return low, high
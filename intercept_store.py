@@ -0,0 +1,115 @@
+import os
+import io
+import json
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+# Define constants
+LINE_COLUMNS = ("model", "crop", "degem", "crop_y", "crop_x", "height", "width",
+                "orientation", "line", "grain_size", "hit_offset", "hit_count")
+HIT_COLUMNS = ("hit_ys", "hit_xs", "hit_arc")
+LABEL_COLUMNS = ("model", "crop", "degem", "crop_y", "crop_x")  # Columns derived from the crop file name
+PART_PREFIX = "part-"
+META_FILENAME = "meta.json"
+
+# Columnar store of per-line intercept records, one directory of .npy columns per appended batch.
+# Every part holds the line columns, one row per (crop, test line), and the hit columns with the
+# raw boundary pixels of all lines, indexed by the hit_offset and hit_count of every line.
+class InterceptStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    # Function to list the parts of the store in the order they were appended
+    def parts(self):
+        return sorted(p for p in os.listdir(self.root) if p.startswith(PART_PREFIX))
+
+    # Function to remove every part of the store
+    def clear(self):
+        for part in os.listdir(self.root):
+            shutil.rmtree(os.path.join(self.root, part))
+
+    # Function to append one batch of line records and their boundary hits as a new part
+    def append(self, columns, meta=None):
+        columns = {name: np.asarray(columns[name]) for name in LINE_COLUMNS[:-2] + ("hit_count",) + HIT_COLUMNS}
+        hit_count = columns["hit_count"].astype(np.int64)
+        columns["hit_offset"] = np.concatenate(([0], np.cumsum(hit_count)[:-1])).astype(np.int64)
+
+        # Write into a hidden directory first so readers never see a half written part
+        part = f"{PART_PREFIX}{len(self.parts()):05d}"
+        tmp_dir = os.path.join(self.root, f".{part}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+        with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+            json.dump(meta or {}, f)
+        os.replace(tmp_dir, os.path.join(self.root, part))
+        return part
+
+    # Function to memory-map the columns of one part
+    def read_part(self, part, columns=LINE_COLUMNS + HIT_COLUMNS):
+        part_dir = os.path.join(self.root, part)
+        return {name: np.load(os.path.join(part_dir, f"{name}.npy"), mmap_mode="r") for name in columns}
+
+    # Function to read the metadata saved with one part
+    def read_meta(self, part):
+        with open(os.path.join(self.root, part, META_FILENAME)) as f:
+            return json.load(f)
+
+    # Function to load the line records of all parts as one DataFrame
+    def to_frame(self, columns=LINE_COLUMNS):
+        frames = [pd.DataFrame({name: np.asarray(values) for name, values in self.read_part(part, columns).items()})
+                  for part in self.parts()]
+        if not frames:
+            return pd.DataFrame({name: [] for name in columns})
+        return pd.concat(frames, ignore_index=True)
+
+    # Function to view the store as the (Model, Degem, Orientation, Grain Size) table of measured lines
+    def grain_sizes(self):
+        df = self.to_frame(("model", "degem", "orientation", "grain_size"))
+        df = df[np.isfinite(df["grain_size"].astype(np.float64))]
+        df = df.rename(columns={"model": "Model", "degem": "Degem", "orientation": "Orientation",
+                                "grain_size": "Grain Size"})
+        df.sort_values(by=['Model', 'Degem', 'Orientation', 'Grain Size'], inplace=True)
+        return df.reset_index(drop=True)
+
+    # Function to export the grain size view of the store to CSV
+    def export_csv(self, csv_path):
+        df = self.grain_sizes()
+        df.to_csv(csv_path, index=False)
+        return df
+
+
+# Function to concatenate the per-crop record columns of several crops into one batch
+def concat_records(records):
+    return {name: np.concatenate([record[name] for record in records]) for name in records[0]}
+
+# Persistent cache of per-crop record columns, keyed by a hash of the crop content and measurement parameters
+class RecordCache:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, data BLOB)")
+
+    # Function to get the cached columns of a key, or None when the key was never measured
+    def get(self, key):
+        row = self.connection.execute("SELECT data FROM records WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with np.load(io.BytesIO(row[0])) as data:
+            return {name: data[name] for name in data.files}
+
+    # Function to store the columns of several keys at once
+    def put_many(self, items):
+        rows = []
+        for key, columns in items:
+            buffer = io.BytesIO()
+            np.savez(buffer, **columns)
+            rows.append((key, buffer.getvalue()))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO records (key, data) VALUES (?, ?)", rows)
+
+    def close(self):
+        self.connection.close()
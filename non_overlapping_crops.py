@@ -1,12 +1,20 @@
 import os
 import cv2
+import numpy as np
+import threading
+from PIL import Image
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count, get_context
 import argparse
+from crop_manifest import CropWindow, MANIFEST_FILENAME, write_manifest
 
 # Constants
 ZONE_SIZE = (256, 256)
 STEP_Y = ZONE_SIZE[1] // 2
 STEP_X = ZONE_SIZE[0] // 2
+WRITER_THREADS = 4  # Threads encoding crops per worker process
+MAX_PENDING_WRITES = 16  # Crops waiting to be encoded before cropping blocks
 
 def extract_info_from_filename(filename):
     "Extract model name and coordinates from the filename."
@@ -50,53 +58,156 @@ def get_intersection(box1, box2):
     h = max(0, yb - ya)
     return w * h
 
-def x_y_in_gt(x, y, delta, gt_zones, modelname):
-    "Check if the given coordinates overlap with ground truth zones."
-    box1 = get_box(x, y, delta)
-    for (y_gt, x_gt) in gt_zones[modelname]:
-        box2 = get_box(x_gt, y_gt, delta)
-        if get_intersection(box1, box2) > 0:
-            return True
-    return False
-
-def crop_images(image_dir, output_dir, zone_size=ZONE_SIZE, gt_image_dir='/path/to/gt'):
-    "Crop images into smaller zones with 50% overlap, avoiding specified ground truth zones."
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+class GTZoneIndex:
+    "Occupancy grid of the GT zone origins of one model, answering window overlap queries in O(1)."
+    def __init__(self, zones, delta):
+        self.delta = delta
+        zones = np.array(sorted(zones), dtype=np.int64).reshape(-1, 2)
 
-    gt_zones = parse_gt_files(gt_image_dir)
-    files = [f for f in os.listdir(image_dir) if f.endswith('.png')]
-    print(f"Total files found: {len(files)}")
+        # Rasterize the zones on the grid of their distinct y and x coordinates
+        self.ys, row = np.unique(zones[:, 0], return_inverse=True)
+        self.xs, col = np.unique(zones[:, 1], return_inverse=True)
+        occupancy = np.zeros((len(self.ys), len(self.xs)), dtype=np.int64)
+        np.add.at(occupancy, (row.ravel(), col.ravel()), 1)
 
-    crop_counts = defaultdict(int)
-    for filename in files:
-        img_path = os.path.join(image_dir, filename)
+        # Summed-area table, padded so that any rectangle sum is four lookups
+        self.sat = np.zeros((len(self.ys) + 1, len(self.xs) + 1), dtype=np.int64)
+        self.sat[1:, 1:] = occupancy.cumsum(axis=0).cumsum(axis=1)
+
+    def count_overlaps(self, y, x):
+        "Count the GT zones overlapping the delta x delta windows at (y, x), for scalars or arrays."
+        y, x = np.asarray(y), np.asarray(x)
+
+        # A zone overlaps a window when both of its coordinates are closer than delta
+        top = np.searchsorted(self.ys, y - self.delta, side='right')
+        bottom = np.searchsorted(self.ys, y + self.delta, side='left')
+        left = np.searchsorted(self.xs, x - self.delta, side='right')
+        right = np.searchsorted(self.xs, x + self.delta, side='left')
+        return self.sat[bottom, right] - self.sat[top, right] - self.sat[bottom, left] + self.sat[top, left]
+
+    def overlaps(self, y, x):
+        "Check if the window at (y, x) overlaps with any GT zone."
+        return bool(self.count_overlaps(y, x) > 0)
+
+    def allowed_windows(self, window_ys, window_xs):
+        "Return a (len(window_ys), len(window_xs)) mask of the windows not overlapping any GT zone."
+        grid_y, grid_x = np.meshgrid(window_ys, window_xs, indexing='ij')
+        return self.count_overlaps(grid_y, grid_x) == 0
+
+def build_gt_index(gt_zones, delta):
+    "Build the GT zone index of every model."
+    return {modelname: GTZoneIndex(zones, delta) for modelname, zones in gt_zones.items()}
+
+def x_y_in_gt(x, y, delta, gt_index, modelname):
+    "Check if the given coordinates overlap with ground truth zones."
+    if modelname not in gt_index:
+        return False
+    return gt_index[modelname].overlaps(y, x)
+
+def crop_single_image(img_path, output_dir, zone_size=ZONE_SIZE, model_index=None, writer_threads=WRITER_THREADS,
+                      manifest=False):
+    "Crop one full image into zones, handing the PNG encodes to a bounded writer thread pool."
+    modelname = os.path.basename(img_path).split('.')[0]
+    if manifest:
+        # A manifest only needs the image size, read from the header without decoding the pixels
+        try:
+            with Image.open(img_path) as im:
+                img_width, img_height = im.size
+        except OSError:
+            print(f"Failed to load image: {img_path}")
+            return modelname, 0, 0, []
+    else:
         img = cv2.imread(img_path)
         if img is None:
             print(f"Failed to load image: {img_path}")
-            continue
-
+            return modelname, 0, 0, []
         img_height, img_width = img.shape[:2]
-        modelname = filename.split('.')[0]
 
-        for y in range(0, img_height - STEP_Y, STEP_Y):
-            for x in range(0, img_width - STEP_X, STEP_X):
-                if x_y_in_gt(x, y, zone_size[0], gt_zones, modelname):
-                    print(f"Skipping zone {modelname}-{y}-{x} as it overlaps with GT zones.")
+    # Check every candidate window of the image against the GT zones at once
+    window_ys = np.arange(0, img_height - STEP_Y, STEP_Y)
+    window_xs = np.arange(0, img_width - STEP_X, STEP_X)
+    if model_index is not None:
+        allowed = model_index.allowed_windows(window_ys, window_xs)
+    else:
+        allowed = np.ones((len(window_ys), len(window_xs)), dtype=bool)
+
+    # The semaphore bounds the number of crops queued for encoding
+    pending = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+    writes, windows = [], []
+    with ThreadPoolExecutor(max_workers=writer_threads) as writers:
+        for i, y in enumerate(window_ys.tolist()):
+            for j, x in enumerate(window_xs.tolist()):
+                if not allowed[i, j]:
                     continue
 
-                crop_img = img[y:y + zone_size[1], x:x + zone_size[0]]
-                if crop_img.shape[0] != zone_size[1] or crop_img.shape[1] != zone_size[0]:
+                if y + zone_size[1] > img_height or x + zone_size[0] > img_width:
                     continue
 
                 output_filename = f"{modelname}-{y}-{x}.png"
+
+                # In manifest mode the crop is only recorded, never encoded
+                if manifest:
+                    windows.append(CropWindow(output_filename, img_path, y, x, zone_size[0], zone_size[1]))
+                    continue
+
+                crop_img = img[y:y + zone_size[1], x:x + zone_size[0]]
                 output_path = os.path.join(output_dir, output_filename)
-                cv2.imwrite(output_path, crop_img)
-                crop_counts[modelname] += 1
-                print(f"Saved {output_path}")
+                pending.acquire()
+                write = writers.submit(cv2.imwrite, output_path, crop_img)
+                write.add_done_callback(lambda _: pending.release())
+                writes.append(write)
+
+    saved = sum(bool(write.result()) for write in writes) + len(windows)
+    return modelname, saved, int((~allowed).sum()), windows
+
+def crop_images(image_dir, output_dir, zone_size=ZONE_SIZE, gt_image_dir='/path/to/gt', workers=1,
+                writer_threads=WRITER_THREADS, manifest=False, executor=None):
+    """Crop images into smaller zones with 50% overlap, avoiding specified ground truth zones (or only list them in a manifest).
+    The images are cropped by the given process pool, which can be shared with other calls, or by a pool of `workers` processes."""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    gt_index = build_gt_index(parse_gt_files(gt_image_dir), zone_size[0])
+    files = [f for f in os.listdir(image_dir) if f.endswith('.png')]
+    print(f"Total files found: {len(files)}")
+
+    jobs = [(os.path.join(image_dir, filename), output_dir, zone_size, gt_index.get(filename.split('.')[0]),
+             writer_threads, manifest) for filename in files]
 
+    crop_counts = defaultdict(int)
+    skipped = 0
+    windows = []
+
+    # Source images are cropped in parallel, one image per task. Workers are spawned, not forked,
+    # as the pipeline calls this from one of its stage threads
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+    try:
+        if executor:
+            futures = [executor.submit(crop_single_image, *job) for job in jobs]
+            results = (future.result() for future in as_completed(futures))
+        else:
+            results = (crop_single_image(*job) for job in jobs)
+
+        for done, (modelname, saved, skipped_zones, image_windows) in enumerate(results, 1):
+            crop_counts[modelname] += saved
+            skipped += skipped_zones
+            windows.extend(image_windows)
+            print(f"Cropped {done}/{len(files)} images, {sum(crop_counts.values())} crops saved", end='\r')
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    print()
+    print(f"Skipped {skipped} zones overlapping with GT zones.")
     print(f"Crop counts per model: {dict(crop_counts)}")
 
+    if manifest:
+        manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        write_manifest(manifest_path, sorted(windows))
+        print(f"Saved crop manifest to {manifest_path}")
+
 
 
 def parse_args():
@@ -114,6 +225,12 @@ def parse_args():
                         help='Directory for MLOgraphy full predictions')
     parser.add_argument('--output_dir2', type=str, required=True, 
                         help='Output directory for or MLOgraphy non verlapping crops(256x256) with GT')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='Number of processes cropping source images in parallel')
+    parser.add_argument('--writer_threads', type=int, default=WRITER_THREADS,
+                        help='Number of threads encoding crops in each process')
+    parser.add_argument('--manifest', action='store_true',
+                        help=f'Write only a crop manifest ({MANIFEST_FILENAME}) to each output directory instead of crop PNGs')
     
     return parser.parse_args()
 
@@ -127,13 +244,26 @@ def main():
         {"image_dir": args.image_dir2, "output_dir": args.output_dir2}
     ]
 
-    for dir_info in dirs:
-        crop_images(
-            image_dir=dir_info["image_dir"],
-            output_dir=dir_info["output_dir"],
-            zone_size=tuple(args.zone_size),
-            gt_image_dir=args.gt_image_dir
-        )
+    # Both directories are cropped at the same time, their images queued on one shared process pool
+    executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context("spawn")) if args.workers > 1 else None
+    try:
+        with ThreadPoolExecutor(max_workers=len(dirs)) as directories:
+            futures = [directories.submit(
+                crop_images,
+                image_dir=dir_info["image_dir"],
+                output_dir=dir_info["output_dir"],
+                zone_size=tuple(args.zone_size),
+                gt_image_dir=args.gt_image_dir,
+                workers=args.workers,
+                writer_threads=args.writer_threads,
+                manifest=args.manifest,
+                executor=executor
+            ) for dir_info in dirs]
+            for future in futures:
+                future.result()
+    finally:
+        if executor:
+            executor.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
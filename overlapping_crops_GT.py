@@ -1,12 +1,14 @@
 import os
 from PIL import Image
 import argparse
+from crop_manifest import CropWindow, MANIFEST_FILENAME, write_manifest
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process and crop images.")
     parser.add_argument('--gt_directory', type=str, required=True, help="Path to the directory containing GT crops (256x256)")
     parser.add_argument('--image_directory', type=str, required=True, help="Path to the directory containing GT annotations_overlayed_on_full_images")
     parser.add_argument('--output_directory', type=str, required=True, help="Path to the directory to save output overlapping crops of GT (256x256)")
+    parser.add_argument('--manifest', action='store_true', help=f"Write only a crop manifest ({MANIFEST_FILENAME}) to the output directory instead of crop PNGs")
     return parser.parse_args()
 
 def extract_model_and_coordinates(filename):
@@ -14,18 +16,22 @@ def extract_model_and_coordinates(filename):
     model, y, x = name.split('-')
     return model, int(y), int(x)
 
-def crop_and_save_image(model, y, x, image_directory, output_directory):
-    img_path = os.path.join(image_directory, f"{model}.png")
-    img = Image.open(img_path)
+def crop_and_save_image(img, model, y, x, output_directory):
     crop = img.crop((x, y, x + 256, y + 256))
     crop.save(os.path.join(output_directory, f"{model}-{y}-{x}.png"))
 
-def main():
-    args = parse_args()
+def crop_and_save_model_images(model, coordinates, image_directory, output_directory):
+    # Decode the full image once and cut all of its windows from memory
+    img_path = os.path.join(image_directory, f"{model}.png")
+    with Image.open(img_path) as img:
+        img.load()
+        for y, x in coordinates:
+            crop_and_save_image(img, model, y, x, output_directory)
 
-    os.makedirs(args.output_directory, exist_ok=True)
+def crop_overlapping_gt(gt_directory, image_directory, output_directory, manifest=False):
+    os.makedirs(output_directory, exist_ok=True)
 
-    original_crops = [extract_model_and_coordinates(f) for f in os.listdir(args.gt_directory) if f.endswith('.png')]
+    original_crops = [extract_model_and_coordinates(f) for f in os.listdir(gt_directory) if f.endswith('.png')]
     original_crops_set = set((model, y, x) for model, y, x in original_crops)
 
     final_crops = []
@@ -49,8 +55,25 @@ def main():
                 final_crops.append((model, y - 128, x))
             final_crops.append((model, y, x))
 
+    # Neighbouring GT crops request the same shifted windows, keep each (model, y, x) once
+    final_crops = list(dict.fromkeys(final_crops))
+
+    if manifest:
+        windows = [CropWindow(f"{model}-{y}-{x}.png", os.path.join(image_directory, f"{model}.png"), y, x, 256, 256)
+                   for model, y, x in final_crops]
+        write_manifest(os.path.join(output_directory, MANIFEST_FILENAME), windows)
+        return
+
+    crops_by_model = {}
     for model, y, x in final_crops:
-        crop_and_save_image(model, y, x, args.image_directory, args.output_directory)
+        crops_by_model.setdefault(model, []).append((y, x))
+
+    for model, coordinates in crops_by_model.items():
+        crop_and_save_model_images(model, coordinates, image_directory, output_directory)
+
+def main():
+    args = parse_args()
+    crop_overlapping_gt(args.gt_directory, args.image_directory, args.output_directory, args.manifest)
 
 if __name__ == "__main__":
     main()
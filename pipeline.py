@@ -0,0 +1,261 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import cpu_count
+from crop_manifest import MANIFEST_FILENAME
+from unify_crops_GT import unify_crops
+from overlapping_crops_GT import crop_overlapping_gt
+from non_overlapping_crops import crop_images
+from grain_size import analyze_images, ORIENTATIONS, RENDER_MODES, CACHE_FILENAME
+
+
+# Define constants
+STATE_DIRNAME = ".pipeline"  # Stamps of completed stages under the work directory
+MAX_PARALLEL_STAGES = 2  # Independent stages run at the same time
+RESULTS_DIRNAME = "results"  # Grain size outputs and cache under the work directory
+
+# Function to output messages
+def output(msg):
+    print(msg)
+
+# Function to fingerprint files and directory trees by their relative paths, sizes and modification times
+def fingerprint(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(f"{path}\0".encode())
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}\0".encode())
+            continue
+        if not os.path.isdir(path):
+            digest.update(b"missing\0")
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                stat = os.stat(file_path)
+                digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+# One step of the pipeline: run(**params, **run_params) reads the inputs and writes the outputs, after the stages
+# it depends on. run_params only change how the stage runs (e.g. its worker count), not its outputs, so they are
+# left out of the stamp
+class Stage:
+    def __init__(self, name, run, inputs, outputs, params=None, deps=(), run_params=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.deps = tuple(deps)
+        self.run_params = run_params or {}
+
+    # Function to build the stamp recording what a run of the stage consumed and produced
+    def stamp(self):
+        return {
+            "params": json.loads(json.dumps(self.params, sort_keys=True, default=str)),
+            "inputs": fingerprint(self.inputs),
+            "outputs": fingerprint(self.outputs),
+        }
+
+# Dependency graph of stages, run with independent branches in parallel and completed stages skipped
+class Pipeline:
+    def __init__(self, stages, state_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir
+        self.order = self._topological_order()
+
+    # Function to order the stages so every stage comes after its dependencies, rejecting cycles
+    def _topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Pipeline has a dependency cycle through stage '{name}'")
+            if name not in self.stages:
+                raise ValueError(f"Unknown pipeline stage '{name}'")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _stamp_path(self, name):
+        return os.path.join(self.state_dir, f"{name}.json")
+
+    # Function to check if a stage already ran with the same parameters and inputs, and its outputs are untouched
+    def is_up_to_date(self, name):
+        stage = self.stages[name]
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        try:
+            with open(self._stamp_path(name)) as f:
+                return json.load(f) == stage.stamp()
+        except (OSError, ValueError):
+            return False
+
+    # Function to run one stage from a clean output, recording its stamp once it succeeded
+    def _run_stage(self, name, force):
+        stage = self.stages[name]
+        if not force and self.is_up_to_date(name):
+            output(f"[{name}] up to date, skipped")
+            return "skipped"
+
+        stamp_path = self._stamp_path(name)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+        for path in stage.outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        output(f"[{name}] running")
+        stage.run(**stage.params, **stage.run_params)
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(stamp_path, "w") as f:
+            json.dump(stage.stamp(), f)
+        output(f"[{name}] done")
+        return "done"
+
+    # Function to run all stages, returns the status of every stage: done, skipped, failed or blocked
+    def run(self, force=(), max_parallel=MAX_PARALLEL_STAGES):
+        status = {}
+        forced = set(self.order) if "all" in force else set(force)
+        # A re-run stage changes its outputs, so everything downstream of it runs again too
+        for name in self.order:
+            if any(dep in forced for dep in self.stages[name].deps):
+                forced.add(name)
+
+        # Stages starting process pools spawn their workers, forking from these threads could deadlock
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            running = {}
+            while len(status) < len(self.order):
+                for name in self.order:
+                    if name in status or name in running.values():
+                        continue
+                    deps = [status.get(dep) for dep in self.stages[name].deps]
+                    if any(dep in ("failed", "blocked") for dep in deps):
+                        output(f"[{name}] blocked by a failed dependency")
+                        status[name] = "blocked"
+                    elif all(dep in ("done", "skipped") for dep in deps):
+                        running[executor.submit(self._run_stage, name, name in forced)] = name
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        output(f"[{name}] failed: {e}")
+                        status[name] = "failed"
+        return status
+
+    # Function to print the stages in dependency order with their up-to-date state
+    def describe(self):
+        # A pending stage changes its outputs when it runs, so everything downstream of it is pending too
+        pending = set()
+        for name in self.order:
+            stage = self.stages[name]
+            if any(dep in pending for dep in stage.deps) or not self.is_up_to_date(name):
+                pending.add(name)
+            state = "pending" if name in pending else "up to date"
+            deps = f" (after {', '.join(stage.deps)})" if stage.deps else ""
+            output(f"{name}{deps}: {state}")
+
+# Function to build the evaluation pipeline: GT unify -> GT crops, prediction crops -> grain size
+def build_pipeline(gt_labels, gt_annotations, mlography_predictions, mlography_plus_plus_predictions, work_dir,
+                   workers=None, manifest=False, orientations=("horizontal",), render="sample", use_cache=True):
+    workers = workers or max(1, cpu_count() // MAX_PARALLEL_STAGES)
+    gt_unified = os.path.join(work_dir, "gt_unified_256")
+    crop_dirs = {
+        "Ground_Truth": os.path.join(work_dir, "gt_overlapping_crops"),
+        "MLOgraphy_Predictions": os.path.join(work_dir, "mlography_crops"),
+        "MLOgraphy++_Predictions": os.path.join(work_dir, "mlography_plus_plus_crops"),
+    }
+    # With manifests the crop stages write one CSV of windows and grain_size cuts them from the full images
+    crop_sources = [(os.path.join(crop_dir, MANIFEST_FILENAME) if manifest else crop_dir, model)
+                    for model, crop_dir in crop_dirs.items()]
+    full_images = [gt_annotations, mlography_predictions, mlography_plus_plus_predictions] if manifest else []
+    results_dir = os.path.join(work_dir, RESULTS_DIRNAME)
+    results = [os.path.join(results_dir, "all_models_grain_sizes.csv"),
+               os.path.join(results_dir, "grain_size_statistics.csv")]
+
+    stages = [
+        Stage("unify_gt", unify_crops, [gt_labels], [gt_unified],
+              dict(input_dir=gt_labels, output_dir=gt_unified), run_params=dict(workers=workers)),
+        Stage("crop_gt", crop_overlapping_gt, [gt_unified, gt_annotations], [crop_dirs["Ground_Truth"]],
+              dict(gt_directory=gt_unified, image_directory=gt_annotations,
+                   output_directory=crop_dirs["Ground_Truth"], manifest=manifest),
+              deps=["unify_gt"]),
+        Stage("crop_mlography", crop_images, [mlography_predictions, gt_labels], [crop_dirs["MLOgraphy_Predictions"]],
+              dict(image_dir=mlography_predictions, output_dir=crop_dirs["MLOgraphy_Predictions"],
+                   gt_image_dir=gt_labels, manifest=manifest),
+              run_params=dict(workers=workers)),
+        Stage("crop_mlography_plus_plus", crop_images, [mlography_plus_plus_predictions, gt_labels],
+              [crop_dirs["MLOgraphy++_Predictions"]],
+              dict(image_dir=mlography_plus_plus_predictions, output_dir=crop_dirs["MLOgraphy++_Predictions"],
+                   gt_image_dir=gt_labels, manifest=manifest),
+              run_params=dict(workers=workers)),
+        Stage("grain_size", analyze_images, list(crop_dirs.values()) + full_images, results,
+              dict(image_dirs=crop_sources, orientations=list(orientations), render=render,
+                   cache_path=os.path.join(results_dir, CACHE_FILENAME) if use_cache else None,
+                   output_dir=results_dir),
+              deps=["crop_gt", "crop_mlography", "crop_mlography_plus_plus"], run_params=dict(workers=workers)),
+    ]
+    return Pipeline(stages, os.path.join(work_dir, STATE_DIRNAME))
+
+# Main function to run the whole evaluation as one resumable job
+def main():
+    parser = argparse.ArgumentParser(description="Run the grain size evaluation end to end, skipping up-to-date stages.")
+    parser.add_argument("--gt_labels", required=True, help="Path to the GT labels (128x128 crops)")
+    parser.add_argument("--gt_annotations", required=True, help="Path to the GT annotations_overlayed_on_full_images")
+    parser.add_argument("--mlography_predictions", required=True, help="Path to the MLOgraphy full predictions")
+    parser.add_argument("--mlography_plus_plus_predictions", required=True, help="Path to the MLOgraphy++ full predictions")
+    parser.add_argument("--work_dir", default="pipeline_work", help="Directory for the intermediate outputs of every stage")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes per stage (default: CPU count split across parallel stages)")
+    parser.add_argument("--max_parallel_stages", type=int, default=MAX_PARALLEL_STAGES,
+                        help="Number of independent stages run at the same time")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Write crop manifests instead of crop PNGs and measure the windows from the full images")
+    parser.add_argument("--orientations", nargs="+", choices=ORIENTATIONS, default=["horizontal"],
+                        help="Test line orientations to measure along")
+    parser.add_argument("--render", choices=RENDER_MODES, default="sample", help="Which crops get a heyn_ overlay rendered")
+    parser.add_argument("--no_cache", action="store_true", help="Measure every crop without the grain size cache")
+    parser.add_argument("--force", nargs="+", default=[],
+                        help="Stages to run even if up to date (with everything downstream), or 'all'")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the stages and whether they are up to date")
+
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(args.gt_labels, args.gt_annotations, args.mlography_predictions,
+                              args.mlography_plus_plus_predictions, args.work_dir, args.workers, args.manifest,
+                              args.orientations, args.render, not args.no_cache)
+    unknown = set(args.force) - set(pipeline.stages) - {"all"}
+    if unknown:
+        parser.error(f"Unknown stages to force: {', '.join(sorted(unknown))}")
+    if args.dry_run:
+        pipeline.describe()
+        return
+
+    status = pipeline.run(args.force, args.max_parallel_stages)
+    output(f"Pipeline finished: {status}")
+    if any(state in ("failed", "blocked") for state in status.values()):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import os
+import argparse
+from grain_size import render_stored, STORE_DIRNAME
+
+def main():
+    parser = argparse.ArgumentParser(description="Render Heyn intercept overlays from stored grain size measurements.")
+    parser.add_argument("--model", required=True, help="Model whose crops to render (e.g. Ground_Truth, MLOgraphy_Predictions)")
+    parser.add_argument("--store", default=os.path.join("results", STORE_DIRNAME), help="Path to the intercept store written by grain_size.py")
+    parser.add_argument("--crops", nargs="*", default=None, help="Crop file names to render (default: all measured crops)")
+    parser.add_argument("--output_dir", default=None, help="Directory to save the heyn_ overlays (default: <model> next to the store)")
+
+    args = parser.parse_args()
+    render_stored(args.store, args.model, args.crops, args.output_dir)
+
+if __name__ == "__main__":
+    main()
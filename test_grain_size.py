@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from PIL import Image
+from grain_size import ORIENTATIONS, boundary_mask, line_intercepts, measure_crops, probe_set
+
+SIZE = 101
+
+
+# A 1 px wide, 8-connected boundary along one image diagonal, through the image center
+def diagonal_boundary(anti_diagonal):
+    plane = np.full((SIZE, SIZE), 255, dtype=np.uint8)
+    xs = np.arange(SIZE)
+    plane[SIZE - 1 - xs if anti_diagonal else xs, xs] = 0
+    return plane[None]
+
+
+@pytest.mark.parametrize("anti_diagonal", [False, True])
+def test_diagonal_boundary_hit_once_by_every_orientation(anti_diagonal):
+    # The probes parallel to the boundary never cross it, every other probe must hit it at each crossing
+    parallel = "diagonal_45" if anti_diagonal else "diagonal_135"
+    orientations = tuple(o for o in ORIENTATIONS if o != parallel)
+    geometry = probe_set(SIZE, SIZE, 10, 2, orientations)
+
+    _, _, hit_line, _, _, _ = line_intercepts(boundary_mask(diagonal_boundary(anti_diagonal)), geometry)
+    counts = np.bincount(hit_line, minlength=geometry.num_lines)
+
+    # Straight lines cross the boundary once, circles around the center twice
+    crossings = np.where(geometry.closed, 2, 1)
+    for orientation in orientations:
+        on_orientation = np.array(geometry.orientations) == orientation
+        assert counts[on_orientation].tolist() == crossings[on_orientation].tolist(), orientation
+
+
+# Mean distance between consecutive black pixels along each horizontal test line, one line at a time
+def reference_d_horiz(pixels, linenum, margin):
+    height, width = pixels.shape[:2]
+    interval = (height - 2 * margin) // (linenum + 1)
+    sizes = []
+    for l in range(linenum):
+        y = margin + interval * (l + 1)
+        on_boundary = [x for x in range(width) if (pixels[y, x] == 0).all()]
+        distances = [x2 - x1 for x1, x2 in zip(on_boundary[:-1], on_boundary[1:])]
+        sizes.append(np.mean(distances) if distances else np.nan)
+    return np.array(sizes)
+
+
+@pytest.mark.parametrize("linenum", [1, 5, 20])
+@pytest.mark.parametrize("margin", [0, 2, 7])
+def test_vectorized_d_horiz_matches_per_line_loop(tmp_path, linenum, margin):
+    # RGB and grayscale crops of several sizes with scattered boundary pixels and some full boundary columns
+    rng = np.random.default_rng(linenum * 100 + margin)
+    crops = []
+    for n, (height, width, channels) in enumerate([(96, 96, 3), (96, 96, 3), (80, 120, 3), (64, 50, None)]):
+        shape = (height, width) if channels is None else (height, width, channels)
+        pixels = rng.integers(1, 256, shape, dtype=np.uint8)
+        pixels[rng.random((height, width)) < 0.08] = 0
+        pixels[:, rng.choice(width, 3, replace=False)] = 0
+        path = str(tmp_path / f"A{n}-0-0.png")
+        Image.fromarray(pixels).save(path)
+        crops.append((path, pixels))
+
+    measured = {f: d_row for f, _, d_row, _, _ in measure_crops([path for path, _ in crops], linenum, margin=margin)}
+    assert len(measured) == len(crops)
+    for path, pixels in crops:
+        np.testing.assert_allclose(measured[path][:linenum], reference_d_horiz(pixels, linenum, margin),
+                                   rtol=1e-12, equal_nan=True)
@@ -1,28 +1,92 @@
 import os
 import cv2
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, get_context
 from PIL import Image
 import numpy as np
 from cv_algorithms import guo_hall
 import argparse
+from non_overlapping_crops import extract_info_from_filename
+
+CHUNK_SIZE = 16  # Number of tiles unified and thinned by one worker task
+INCOMPLETE_MODES = ('skip', 'pad')  # What to do with tiles missing some of their sub-tiles
+PAD_COLOR = (255, 255, 255)  # Missing sub-tiles are padded with background, never with boundary (black) pixels
 
 def create_directory(path):
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
 
-def unify_crops(input_dir, output_dir, crop_size=256, unified_size=128):
+# Index the model-y-x-dy-dx crop names by parent tile: {(model, y, x): {(dy, dx): filename}}
+def index_tiles(files):
+    tiles = defaultdict(dict)
+    for filename in files:
+        modelname, y, x, dy, dx = extract_info_from_filename(filename)
+        if modelname is not None:
+            tiles[(modelname, y, x)][(dy, dx)] = filename
+    return tiles
+
+# Stitch the sub-tiles of one tile into one unified image in memory, each at its (dy, dx) offset
+def stitch_crops(input_dir, subtiles, crop_size=256, fill=PAD_COLOR):
+    unified_image = Image.new('RGB', (crop_size, crop_size), fill)
+    for (dy, dx), filename in subtiles.items():
+        with Image.open(os.path.join(input_dir, filename)) as crop_image:
+            unified_image.paste(crop_image, (dx, dy))
+    return unified_image
+
+# Stitch, optionally thin and save a chunk of tiles, every unified image is encoded exactly once
+def unify_crop_groups(input_dir, output_dir, tiles, crop_size=256, thin=True, fill=PAD_COLOR):
+    for (modelname, y, x), subtiles in tiles:
+        unified_image = stitch_crops(input_dir, subtiles, crop_size, fill)
+        if thin:
+            # Same as thinning the saved RGB image re-read in grayscale
+            unified_image = Image.fromarray(apply_guo_hall_thinning(unified_image.convert('L')))
+
+        unified_image.save(os.path.join(output_dir, f"{modelname}-{y}-{x}.png"))
+    return len(tiles)
+
+def unify_crops(input_dir, output_dir, crop_size=256, unified_size=128, thin=True, workers=1, chunk_size=CHUNK_SIZE,
+                incomplete='skip', shard_index=0, num_shards=1):
     create_directory(output_dir)  # Ensure the output directory is created
-    files = sorted(os.listdir(input_dir))
-    for i in range(0, len(files), 4):
-        unified_image = Image.new('RGB', (crop_size, crop_size), (0, 0, 0))
-        for j in range(4):
-            crop_image = Image.open(os.path.join(input_dir, files[i + j]))
-            x = (j % 2) * unified_size
-            y = (j // 2) * unified_size
-            unified_image.paste(crop_image, (x, y))
-
-        new_filename = '-'.join(files[i].split('-')[:3]) + '.png'
-        unified_image.save(os.path.join(output_dir, new_filename))
+    files = [f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.tif'))]
+    expected = {(dy, dx) for dy in range(0, crop_size, unified_size) for dx in range(0, crop_size, unified_size)}
+
+    # Tiles are assembled from the parsed coordinates, so any subset of them can be unified on its own
+    tiles = []
+    for tile, subtiles in sorted(index_tiles(files).items())[shard_index::num_shards]:
+        unexpected = sorted(set(subtiles) - expected)
+        missing = sorted(expected - set(subtiles))
+        if unexpected:
+            print(f"Tile {'-'.join(map(str, tile))}: ignoring sub-tiles at unexpected offsets {unexpected}")
+            subtiles = {offset: subtiles[offset] for offset in expected.intersection(subtiles)}
+        if missing:
+            print(f"Tile {'-'.join(map(str, tile))} is missing sub-tiles {missing}, "
+                  f"{'padding them' if incomplete == 'pad' else 'skipping it'}")
+            if incomplete != 'pad':
+                continue
+        tiles.append((tile, subtiles))
+    chunks = [tiles[i:i + chunk_size] for i in range(0, len(tiles), chunk_size)]
+
+    # Chunks of crop groups are unified and thinned in parallel, one chunk per task. Workers are
+    # spawned, not forked, as the pipeline calls this from one of its stage threads
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) if workers > 1 else None
+    try:
+        if executor:
+            futures = [executor.submit(unify_crop_groups, input_dir, output_dir, chunk, crop_size, thin)
+                       for chunk in chunks]
+            results = (future.result() for future in as_completed(futures))
+        else:
+            results = (unify_crop_groups(input_dir, output_dir, chunk, crop_size, thin)
+                       for chunk in chunks)
+
+        done = 0
+        for unified in results:
+            done += unified
+            print(f"Unified {done}/{len(tiles)} images", end='\r')
+    finally:
+        if executor:
+            executor.shutdown()
+    print()
 
 def apply_guo_hall_thinning(image):
     image = np.array(image)
@@ -32,41 +96,27 @@ def apply_guo_hall_thinning(image):
     return thinned_image
 
 
-# Process each image in the input directory and save the thinned images
-def process_and_thin_images(input_dir, output_dir):
-    # Ensure the output directory is created
-    os.makedirs(output_dir, exist_ok=True)
-    
-    for image_name in os.listdir(input_dir):
-        if image_name.lower().endswith(('.png', '.jpg', '.tif')):
-            input_path = os.path.join(input_dir, image_name)
-            print(f"Processing image: {input_path}")
-            
-            # Convert the image to grayscale and apply Guo-Hall thinning
-            grayscale_image = Image.open(input_path).convert('L')
-            thinned_image = apply_guo_hall_thinning(grayscale_image)
-            
-            # Save the thinned image
-            final_image = Image.fromarray(thinned_image)
-            output_path = os.path.join(output_dir, image_name)
-            final_image.save(output_path)
-            print(f"Saved processed image: {output_path}")
-
-
 def main():
     parser = argparse.ArgumentParser(description="Process and unify image labels crops for metallography analysis.")
     parser.add_argument('--gt_path', type=str, required=True, 
                         help="Path to the directory containing the GT labels(128x128).")
     parser.add_argument('--gt_output_path', type=str, required=True, 
                         help="Output path for the unified ground truth crops(256x256).")
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help="Number of processes unifying and thinning crops in parallel.")
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                        help="Number of unified images produced by one worker task.")
+    parser.add_argument('--incomplete', choices=INCOMPLETE_MODES, default='skip',
+                        help="Skip tiles missing some of their 128x128 sub-tiles, or pad the missing sub-tiles with background.")
+    parser.add_argument('--shard', type=int, nargs=2, default=(0, 1), metavar=('INDEX', 'COUNT'),
+                        help="Only unify every COUNT-th tile starting at INDEX, to split the work across machines.")
 
     args = parser.parse_args()
 
-    # Unify the 128x128 GT crops into 256x256 images
+    # Unify the 128x128 GT crops into 256x256 images and apply Guo-Hall thinning in one pass
     create_directory(args.gt_output_path)
-    unify_crops(args.gt_path, args.gt_output_path)
-     # Apply Guo-Hall thinning
-    process_and_thin_images(args.gt_output_path, args.gt_output_path)
+    unify_crops(args.gt_path, args.gt_output_path, workers=args.workers, chunk_size=args.chunk_size,
+                incomplete=args.incomplete, shard_index=args.shard[0], num_shards=args.shard[1])
 
 if __name__ == "__main__":
     main()